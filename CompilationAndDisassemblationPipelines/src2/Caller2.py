@@ -137,9 +137,13 @@ def main():
 
             dfs_filtered = analyzer.confronta_blocchi(dfs_result, last_address_str, start_node_str)
             print("Filtered DFS blocks:", dfs_filtered)
+
+            # Full block-level CFG, the BFS/DFS orderings above drop its edges
+            cfg_edges = graph.edge_list(result, start_node)
+            print("CFG blocks and edges:", len(cfg_edges['nodes']), len(cfg_edges['edges']))
           
             # Add all information to functions_info
-            functions_info.append((function[0], hex(function[2]), assembly_code, address, bytecodes, bfs_filtered, dfs_filtered))
+            functions_info.append((function[0], hex(function[2]), assembly_code, address, bytecodes, bfs_filtered, dfs_filtered, cfg_edges))
                         
         # Verify and replace empty values in functions_info
         functions_info_checked = []
@@ -151,7 +155,8 @@ def main():
             bytecodes = function[4] if function[4] else "NULL"
             bfs_result = json.dumps(function[5]) if function[5] else "NULL"
             dfs_result = json.dumps(function[6]) if function[6] else "NULL"
-            functions_info_checked.append((function_name, function_entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result))
+            cfg_edges = json.dumps(function[7], separators=(',', ':')) if function[7]['nodes'] else "NULL"
+            functions_info_checked.append((function_name, function_entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, cfg_edges))
 
         # Print and format the call graph for database insertion
         call_graph_str = ""
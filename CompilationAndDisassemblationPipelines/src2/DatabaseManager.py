@@ -29,7 +29,7 @@ class DatabaseManager:
         c.execute('''CREATE TABLE IF NOT EXISTS function_info
                     (function_id INTEGER PRIMARY KEY AUTOINCREMENT, filename_id INTEGER,
                     function_name TEXT, entry_point TEXT, address TEXT, assembly_code TEXT, 
-                    bytecodes TEXT, bfs_result TEXT, dfs_result TEXT,
+                    bytecodes TEXT, bfs_result TEXT, dfs_result TEXT, cfg_edges TEXT,
                     FOREIGN KEY(filename_id) REFERENCES info(id))''')
         conn.commit()
         conn.close()
@@ -53,9 +53,9 @@ class DatabaseManager:
             bytecodes_str_cleaned = bytecodes_str.replace("\n", "  ")  # Remove newline characters
             address_str = "\n".join(function_info[2])  # It is not necessary to convert if it's already a string
             address_str_cleaned = address_str.replace("\n", "  ")  # Remove newline characters
-            c.execute('''INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result) 
-                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                        (last_row_id, function_info[0], function_info[1], address_str_cleaned, assembly_code_str_cleaned, bytecodes_str_cleaned, function_info[5], function_info[6]))
+            c.execute('''INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, cfg_edges) 
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (last_row_id, function_info[0], function_info[1], address_str_cleaned, assembly_code_str_cleaned, bytecodes_str_cleaned, function_info[5], function_info[6], function_info[7]))
 
         conn.commit()
         conn.close()
@@ -9,6 +9,28 @@ class GraphManager:
                 G.add_edge(node, dest)  # Edges
         return G
 
+    # Compact form of the block-level CFG stored in the database: the block addresses, the start
+    # block first, and the directed edges as pairs of indices into that list.
+    def edge_list(self, result_dict, start_node):
+        nodes = []
+        index = {}
+
+        def node_index(node):
+            if node not in index:
+                index[node] = len(nodes)
+                nodes.append(node)
+            return index[node]
+
+        if start_node is not None:
+            node_index(start_node)
+
+        edges = []
+        for block, destinations in result_dict.items():
+            source = node_index(block)
+            for dest in destinations:
+                edges.append([source, node_index(dest)])
+        return {'nodes': nodes, 'edges': edges}
+
     # Visit a node and then explore all its neighbors before moving on to the neighbors of its neighbors.
     def bfs(self, graph, start_node):
         if start_node is None or start_node not in graph:
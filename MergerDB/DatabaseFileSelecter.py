@@ -52,6 +52,7 @@ class DatabaseFileSelector:
                 bytecodes TEXT,
                 bfs_result TEXT,
                 dfs_result TEXT,
+                cfg_edges TEXT,
                 FOREIGN KEY (filename_id) REFERENCES info (id)
             )
         ''')
@@ -69,14 +70,17 @@ class DatabaseFileSelector:
         new_file_id = cur_new.lastrowid
 
         # Copy data from the 'function_info' table related to the selected file
-        cur_original.execute("SELECT * FROM function_info WHERE filename_id = ?", (file_id,))
+        # Databases built before the CFGs were stored have no cfg_edges column, NULL is copied instead
+        cur_original.execute("PRAGMA table_info(function_info)")
+        cfg_edges_column = "cfg_edges" if any(column[1] == "cfg_edges" for column in cur_original.fetchall()) else "NULL"
+        cur_original.execute(f"SELECT function_id, filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, {cfg_edges_column} FROM function_info WHERE filename_id = ?", (file_id,))
         function_info_rows = cur_original.fetchall()
 
         for function_row in function_info_rows:
             cur_new.execute('''
-                INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (new_file_id, function_row[2], function_row[3], function_row[4], function_row[5], function_row[6], function_row[7], function_row[8]))
+                INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, cfg_edges)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (new_file_id, function_row[2], function_row[3], function_row[4], function_row[5], function_row[6], function_row[7], function_row[8], function_row[9]))
 
         # Commit changes and close the connection
         new_conn.commit()
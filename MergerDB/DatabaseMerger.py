@@ -44,6 +44,7 @@ class DatabaseMerger:
             bytecodes TEXT,
             bfs_result TEXT,
             dfs_result TEXT,
+            cfg_edges TEXT,
             FOREIGN KEY (filename_id) REFERENCES info (id)
         )
         ''')
@@ -69,15 +70,18 @@ class DatabaseMerger:
 
         # Function to copy data from the function_info table with mapped IDs
         def copy_function_info_data(cur_source, cur_dest, id_map):
-            cur_source.execute("SELECT function_id, filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result FROM function_info")
+            # Databases built before the CFGs were stored have no cfg_edges column, NULL is copied instead
+            cur_source.execute("PRAGMA table_info(function_info)")
+            cfg_edges_column = "cfg_edges" if any(column[1] == "cfg_edges" for column in cur_source.fetchall()) else "NULL"
+            cur_source.execute(f"SELECT function_id, filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, {cfg_edges_column} FROM function_info")
             rows = cur_source.fetchall()
 
             for row in rows:
                 new_filename_id = id_map.get(row[1])
                 cur_dest.execute('''
-                    INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (new_filename_id, row[2], row[3], row[4], row[5], row[6], row[7], row[8]))
+                    INSERT INTO function_info (filename_id, function_name, entry_point, address, assembly_code, bytecodes, bfs_result, dfs_result, cfg_edges)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (new_filename_id, row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
 
         # Iterate through all .db files in the specified folder
         for db_file in os.listdir(self.db_folder_path):
@@ -3,14 +3,18 @@
 import os
 import sqlite3
 import json
+import atexit
+import threading
 import numpy as np
-import tensorflow as tf
 from capstone import *
 from capstone.arm64 import *
 
 class DatabaseFunctionAnalyzer:
-    def __init__(self, db_path):
+    def __init__(self, db_path, max_memo_entries=1 << 20):
         self.db_path = db_path
+        # Tokens already computed, indexed by (mnemonic, op_str)
+        self.token_memo = {}
+        self.max_memo_entries = max_memo_entries
 
     def get_functions_info_from_db(self):
         conn = sqlite3.connect(self.db_path)
@@ -104,6 +108,80 @@ class DatabaseFunctionAnalyzer:
         return "A_" + inst
 
     def analyze(self, instructions):
+        """
+        Converts Capstone instructions into SAFE tokens (A_...).
+
+        Tokens are memoized by (mnemonic, op_str), so every distinct instruction text is
+        parsed once. Produces the same tokens as analyze_op_str.
+        """
+        result = []
+        memo = self.token_memo
+        for instruction in instructions:
+            key = (instruction.mnemonic, instruction.op_str)
+            token = memo.get(key)
+            if token is None:
+                token = DatabaseFunctionAnalyzer.tokenize(instruction.mnemonic, instruction.op_str)
+                if len(memo) >= self.max_memo_entries:
+                    memo.clear()
+                memo[key] = token
+            result.append(token)
+        return result
+
+    @staticmethod
+    def split_operands(op_str):
+        # Splits op_str on the commas outside the memory brackets, as analyze_op_str does
+        pieces = op_str.split(',')
+        if '[' not in op_str and ']' not in op_str:
+            # A trailing empty piece is not an operand
+            if not pieces[-1]:
+                pieces.pop()
+            return [operand.strip() for operand in pieces]
+
+        operands = []
+        current_op = None
+        inside_mem = False
+        for piece in pieces:
+            current_op = piece if current_op is None else current_op + ',' + piece
+            # The last bracket of the piece decides whether the next comma is inside the memory operand
+            open_pos = piece.rfind('[')
+            close_pos = piece.rfind(']')
+            if open_pos > close_pos:
+                inside_mem = True
+            elif close_pos > open_pos:
+                inside_mem = False
+            if not inside_mem:
+                operands.append(current_op.strip())
+                current_op = None
+
+        if current_op:
+            operands.append(current_op.strip())
+        elif current_op is None and not pieces[-1]:
+            operands.pop()
+        return operands
+
+    @staticmethod
+    def tokenize(mnemonic, op_str):
+        # Same token as filter_memory_references, built without the intermediate operand dictionaries
+        inst = mnemonic
+        for operand in DatabaseFunctionAnalyzer.split_operands(op_str):
+            if operand.startswith(('x', 'w', 'sp', 'fp', 'lr')):
+                inst += " " + operand
+            elif operand.startswith('#'):
+                inst += " " + DatabaseFunctionAnalyzer.filter_imm({"value": operand})
+            elif '[' in operand and ']' in operand:
+                base_disp = operand.strip('[]').split(',')
+                base = base_disp[0].strip()
+                disp = base_disp[1].strip().replace('#', '') if len(base_disp) > 1 else '0'
+                inst += f"[{base}*1+{disp}]".replace('0*1+0', 'MEM')
+            inst += ","
+
+        inst = inst.rstrip(',')
+        inst = inst.replace(" ", "_")
+
+        return "A_" + inst
+
+    def analyze_op_str(self, instructions):
+        # Reference tokenizer, parses the op_str of every instruction one character at a time
         result = []
         for instruction in instructions:
             mnemonic = instruction.mnemonic
@@ -189,54 +267,143 @@ class FunctionNormalizer:
             f = np.pad(f, (0, self.max_instructions - f.shape[0]), mode='constant')
         return f, length
 
+    def write_function(self, f, matrix, row):
+        # Copies the first max_instructions ids of f in a zero padded row of matrix, returns the length
+        length = min(len(f), self.max_instructions)
+        matrix[row, :length] = f[:length]
+        return length
+
     def normalize_function_pairs(self, pairs):
-        lengths = []
-        new_pairs = []
-        for x in pairs:
-            f0, len0 = self.normalize(x[0])
-            f1, len1 = self.normalize(x[1])
-            lengths.append((len0, len1))
-            new_pairs.append((f0, f1))
+        """
+        Pads the pairs of functions in a preallocated matrix.
+
+        :param pairs: List of pairs of token id sequences
+        :return: int32 matrix of shape (n, 2, max_instructions) and int32 lengths of shape (n, 2)
+        """
+        new_pairs = np.zeros((len(pairs), 2, self.max_instructions), dtype=np.int32)
+        lengths = np.empty((len(pairs), 2), dtype=np.int32)
+        for i, x in enumerate(pairs):
+            lengths[i, 0] = self.write_function(x[0], new_pairs[:, 0], i)
+            lengths[i, 1] = self.write_function(x[1], new_pairs[:, 1], i)
         return new_pairs, lengths
 
     def normalize_functions(self, functions):
-        lengths = []
-        new_functions = []
-        for f in functions:
-            f, length = self.normalize(f)
-            lengths.append(length)
-            new_functions.append(f)
+        """
+        Pads the functions in a preallocated matrix, ready to be fed to SAFEEmbedder.embedd.
+
+        :param functions: List of token id sequences
+        :return: int32 matrix of shape (n, max_instructions) and int32 lengths of shape (n,)
+        """
+        new_functions = np.zeros((len(functions), self.max_instructions), dtype=np.int32)
+        lengths = np.empty(len(functions), dtype=np.int32)
+        for i, f in enumerate(functions):
+            lengths[i] = self.write_function(f, new_functions, i)
         return new_functions, lengths
 
 
 class SAFEEmbedder:
-    def __init__(self, model_file):
+    # TensorFlow is imported by the methods that need it, importing this module does not load it:
+    # the tokenizer worker processes (see TokenizerWorker) only use the classes above
+    # Embedders shared by the whole process, indexed by model file
+    _shared_embedders = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, model_file, intra_op_threads=0, inter_op_threads=0):
+        import tensorflow as tf
+
         self.model_file = model_file
         self.graph = tf.Graph()  # Create a new TensorFlow graph.
         self.session = None
         self.x_1 = None
         self.len_1 = None
         self.emb = None
+        # 0 lets TensorFlow pick the number of threads
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+
+    @classmethod
+    def get_shared(cls, model_file, intra_op_threads=0, inter_op_threads=0, warmup_batch_size=1, max_instructions=150):
+        """
+        Returns the embedder of model_file shared by the whole process, loading it on first use.
+
+        The frozen graph is parsed once and the normalization op is built once. Session.run is
+        thread safe, so the returned embedder can be used from several threads at the same time.
+
+        :param model_file: Path of the frozen SAFE model
+        :param intra_op_threads: Threads used inside a single op (0 means TensorFlow default)
+        :param inter_op_threads: Threads used to run independent ops (0 means TensorFlow default)
+        :param warmup_batch_size: Size of the batch run once after loading, 0 disables the warm-up
+        :param max_instructions: Length of the padded sequences fed to the model
+        :return: SAFEEmbedder ready to embedd
+        """
+        model_file = os.path.abspath(model_file)
+        with cls._shared_lock:
+            embedder = cls._shared_embedders.get(model_file)
+            if embedder is None:
+                embedder = cls(model_file, intra_op_threads, inter_op_threads)
+                embedder.loadmodel()
+                embedder.get_tensor()
+                if warmup_batch_size > 0:
+                    embedder.warmup(warmup_batch_size, max_instructions)
+                cls._shared_embedders[model_file] = embedder
+            return embedder
+
+    @classmethod
+    def close_shared(cls):
+        with cls._shared_lock:
+            for embedder in cls._shared_embedders.values():
+                embedder.close()
+            cls._shared_embedders.clear()
 
     def loadmodel(self):
+        if self.session is not None:
+            return self.session
+
+        import tensorflow as tf
+
+        config = tf.compat.v1.ConfigProto(
+            intra_op_parallelism_threads=self.intra_op_threads,
+            inter_op_parallelism_threads=self.inter_op_threads
+        )
         with self.graph.as_default():  # Use the new graph as the default graph.
             with tf.io.gfile.GFile(self.model_file, "rb") as f:
                 graph_def = tf.compat.v1.GraphDef()
                 graph_def.ParseFromString(f.read())
                 tf.import_graph_def(graph_def)
-                self.session = tf.compat.v1.Session(graph=self.graph)  # Create the session using the new graph
+                self.session = tf.compat.v1.Session(graph=self.graph, config=config)  # Create the session using the new graph
         return self.session
 
     def get_tensor(self):
+        # The normalization op is added to the graph only the first time
+        if self.emb is not None:
+            return
+
+        import tensorflow as tf
+
         with self.graph.as_default():  # Use the new graph as the default graph.
             self.x_1 = self.session.graph.get_tensor_by_name("import/x_1:0")
             self.len_1 = self.session.graph.get_tensor_by_name("import/lengths_1:0")
             self.emb = tf.nn.l2_normalize(self.session.graph.get_tensor_by_name('import/Embedding1/dense/BiasAdd:0'), axis=1)
+        self.graph.finalize()
+
+    def warmup(self, batch_size=1, max_instructions=150):
+        # The first session.run allocates the kernels, so it is paid here and not by the first real batch
+        nodi_input = np.zeros((batch_size, max_instructions), dtype=np.int32)
+        lengths_input = np.ones(batch_size, dtype=np.int32)
+        self.embedd(nodi_input, lengths_input)
 
     def embedd(self, nodi_input, lengths_input):
-        with self.graph.as_default():  # Use the new graph as the default graph.
-            out_embedding = self.session.run(self.emb, feed_dict={
-                self.x_1: nodi_input,
-                self.len_1: lengths_input
-            })
+        out_embedding = self.session.run(self.emb, feed_dict={
+            self.x_1: nodi_input,
+            self.len_1: lengths_input
+        })
         return out_embedding
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+
+# Shared sessions are closed when the process exits
+atexit.register(SAFEEmbedder.close_shared)
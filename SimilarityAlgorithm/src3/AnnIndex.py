@@ -0,0 +1,198 @@
+import os
+import time
+import numpy as np
+from EmbeddingStore import EmbeddingStore
+
+class AnnIndex:
+    """
+    Approximate nearest-neighbour index (IVF) over the SAFE embeddings of a reference database.
+
+    The embeddings are clustered with spherical k-means; every embedding is stored in the
+    inverted list of its closest centroid. A query only scores the embeddings of the n_probe
+    lists whose centroids are the most similar to it: a larger n_probe gives a higher recall
+    for a longer query time, n_probe = n_lists is an exact search.
+    """
+
+    def __init__(self, function_ids, embeddings, n_lists=None, n_probe=8, iterations=10, seed=0):
+        embeddings = AnnIndex.as_rows(embeddings)
+        if n_lists is None:
+            # Usual IVF rule of thumb, about sqrt(n) lists
+            n_lists = max(1, int(np.sqrt(len(embeddings))))
+        n_lists = max(1, min(n_lists, len(embeddings)))
+
+        self.n_probe = n_probe
+        self.centroids = AnnIndex.spherical_kmeans(embeddings, n_lists, iterations, seed)
+        assignments = np.argmax(embeddings @ self.centroids.T, axis=1) if len(embeddings) > 0 else np.zeros(0, dtype=np.int64)
+
+        # Inverted lists stored contiguously: list l holds the rows offsets[l]:offsets[l + 1]
+        order = np.argsort(assignments, kind='stable')
+        self.embeddings = np.ascontiguousarray(embeddings[order])
+        self.function_ids = np.asarray(function_ids, dtype=np.int64)[order]
+        self.offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(assignments, minlength=n_lists))
+
+    @classmethod
+    def from_store(cls, store, n_lists=None, n_probe=8, iterations=10, seed=0):
+        """
+        Builds the index over every function of an EmbeddingStore (created by EmbeddingStore.from_data).
+        """
+        return cls(store.function_ids, store.vectors(list(range(len(store.keys)))), n_lists, n_probe, iterations, seed)
+
+    @staticmethod
+    def as_rows(matrix):
+        # float32 matrix with one embedding per row, reshape(len(matrix), -1) fails on an empty input
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if len(matrix) == 0:
+            return matrix.reshape(0, matrix.shape[-1] if matrix.ndim > 1 else 0)
+        return matrix.reshape(len(matrix), -1)
+
+    @staticmethod
+    def spherical_kmeans(embeddings, n_lists, iterations=10, seed=0):
+        """
+        k-means on the unit sphere: points are assigned by dot product and centroids renormalized.
+
+        :return: float32 matrix of n_lists unit centroids
+        """
+        rng = np.random.default_rng(seed)
+        if len(embeddings) == 0:
+            return np.zeros((n_lists, embeddings.shape[1]), dtype=np.float32)
+
+        centroids = embeddings[rng.choice(len(embeddings), n_lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(embeddings @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, embeddings)
+            counts = np.bincount(assignments, minlength=n_lists)
+
+            # Empty lists restart from a random embedding
+            empty = counts == 0
+            sums[empty] = embeddings[rng.choice(len(embeddings), int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = (sums / np.where(norms > 0, norms, 1)).astype(np.float32)
+
+        return centroids
+
+    def query(self, embedding, k, n_probe=None):
+        """
+        :param embedding: Embedding of the query function
+        :param k: Number of neighbours
+        :param n_probe: Number of inverted lists scanned, defaults to the one of the index
+        :return: (function ids, scores) of the k most similar functions found, by decreasing score
+        """
+        ids, scores = self.batch_query(np.asarray(embedding, dtype=np.float32).reshape(1, -1), k, n_probe)
+        valid = ids[0] >= 0
+        return ids[0][valid], scores[0][valid]
+
+    def batch_query(self, matrix, k, n_probe=None):
+        """
+        :param matrix: Embeddings of the query functions, one per row
+        :param k: Number of neighbours per query
+        :param n_probe: Number of inverted lists scanned, defaults to the one of the index
+        :return: (function ids, scores) matrices of shape (queries, k) by decreasing score,
+                 padded with id -1 and score -inf when fewer than k functions were scanned
+        """
+        matrix = AnnIndex.as_rows(matrix)
+        n_lists = len(self.centroids)
+        n_probe = min(n_probe if n_probe is not None else self.n_probe, n_lists)
+
+        if n_probe >= n_lists:
+            return self.exact_batch_query(matrix, k)
+
+        ids = np.full((len(matrix), k), -1, dtype=np.int64)
+        scores = np.full((len(matrix), k), -np.inf, dtype=np.float32)
+        if len(matrix) == 0 or len(self.embeddings) == 0:
+            return ids, scores
+
+        probes = np.argpartition(-(matrix @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        for q in range(len(matrix)):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in probes[q]])
+            candidate_scores = self.embeddings[rows] @ matrix[q]
+            top = min(k, len(rows))
+            if top == 0:
+                continue
+            best = np.argpartition(-candidate_scores, top - 1)[:top]
+            best = best[np.argsort(-candidate_scores[best], kind='stable')]
+            ids[q, :top] = self.function_ids[rows[best]]
+            scores[q, :top] = candidate_scores[best]
+
+        return ids, scores
+
+    def exact_batch_query(self, matrix, k):
+        # Brute-force search over every embedding in blocks of 256 queries, the reference for recall_at_k
+        matrix = AnnIndex.as_rows(matrix)
+        ids = np.full((len(matrix), k), -1, dtype=np.int64)
+        scores = np.full((len(matrix), k), -np.inf, dtype=np.float32)
+        top = min(k, len(self.embeddings))
+        if top == 0:
+            return ids, scores
+
+        for start in range(0, len(matrix), 256):
+            block = matrix[start:start + 256] @ self.embeddings.T
+            best = np.argpartition(-block, top - 1, axis=1)[:, :top]
+            best_scores = np.take_along_axis(block, best, axis=1)
+            order = np.argsort(-best_scores, axis=1, kind='stable')
+            ids[start:start + 256, :top] = self.function_ids[np.take_along_axis(best, order, axis=1)]
+            scores[start:start + 256, :top] = np.take_along_axis(best_scores, order, axis=1)
+
+        return ids, scores
+
+    def recall_at_k(self, matrix, k, n_probe=None):
+        """
+        Fraction of the exact k nearest neighbours returned by batch_query, printed with the
+        time of both searches.
+
+        :param matrix: Embeddings of the query functions, one per row
+        :return: recall@k
+        """
+        start = time.perf_counter()
+        exact_ids, _ = self.exact_batch_query(matrix, k)
+        exact_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        ids, _ = self.batch_query(matrix, k, n_probe)
+        ann_time = time.perf_counter() - start
+
+        found = sum(len(set(exact_row[exact_row >= 0]) & set(row[row >= 0])) for exact_row, row in zip(exact_ids, ids))
+        total = int((exact_ids >= 0).sum())
+        recall = found / total if total > 0 else 1.0
+
+        print(f"ANN index ({len(self.centroids)} lists, n_probe {n_probe if n_probe is not None else self.n_probe}): "
+              f"recall@{k} {recall:.4f} over {len(matrix)} queries, {ann_time * 1000:.1f} ms vs {exact_time * 1000:.1f} ms exact")
+        return recall
+
+    @staticmethod
+    def index_path(db_path):
+        return os.path.splitext(db_path)[0] + '.ann.npz'
+
+    def save(self, db_path, model_hash):
+        """
+        Writes the index next to db_path, it is valid as long as the database and model do not change.
+        """
+        path = AnnIndex.index_path(db_path)
+        database = EmbeddingStore.database_fingerprint(db_path)
+        EmbeddingStore.atomic_write(path, 'wb', lambda f: np.savez(
+            f, centroids=self.centroids, embeddings=self.embeddings, function_ids=self.function_ids,
+            offsets=self.offsets, n_probe=self.n_probe, model_hash=model_hash, database=database
+        ))
+        print(f"Saved the ANN index of {len(self.function_ids)} functions to {path}")
+
+    @classmethod
+    def load(cls, db_path, model_hash):
+        """
+        :return: AnnIndex saved by save for db_path, or None if there is none or it is stale
+        """
+        path = AnnIndex.index_path(db_path)
+        if not os.path.exists(path):
+            return None
+
+        with np.load(path) as saved:
+            if str(saved['model_hash']) != model_hash or str(saved['database']) != EmbeddingStore.database_fingerprint(db_path):
+                return None
+            index = cls.__new__(cls)
+            index.centroids = saved['centroids']
+            index.embeddings = saved['embeddings']
+            index.function_ids = saved['function_ids']
+            index.offsets = saved['offsets']
+            index.n_probe = int(saved['n_probe'])
+        return index
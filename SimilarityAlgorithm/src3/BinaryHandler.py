@@ -1,11 +1,14 @@
 import os
 import sqlite3
 import json
+import time
 import networkx as nx
 from capstone import *
 from capstone.arm64 import *
 from Analysis import DatabaseFunctionAnalyzer, InstructionsConverter, FunctionNormalizer, SAFEEmbedder
 from PairWiseSimilarity import PairWiseSimilarity
+from GraphSimilarityCache import GraphSimilarityCache
+from CFGKernel import CFGKernel
 import pprint
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
@@ -13,8 +16,10 @@ from node2vec import Node2Vec
 from networkx.algorithms.similarity import graph_edit_distance
 
 class BinaryHandler:
+    # Memo of the BFS/DFS graph similarities by structural signature, replaced by a persistent one in CallerSim
+    similarity_cache = GraphSimilarityCache()
 
-    def compute_fuzzy_similarity(prof_common, embeddings1_unmatched, embeddings2_unmatched, threshold):
+    def compute_fuzzy_similarity(prof_common, embeddings1_unmatched, embeddings2_unmatched, threshold, matching='greedy', top_k=10):
         """
         Compute fuzzy similarity between unmatched embeddings of two sets of functions.
         
@@ -22,12 +27,31 @@ class BinaryHandler:
         :param embeddings1_unmatched: List of unmatched embeddings from the first file
         :param embeddings2_unmatched: List of unmatched embeddings from the second file
         :param threshold: Similarity threshold for fuzzy matching
+        :param matching: 'greedy', 'hungarian' (optimal assignment) or 'sparse' (optimal assignment on the top_k candidates of every function)
+        :param top_k: Candidates per function of the 'sparse' matching
         :return: List of fuzzy matches and the weighted average similarity
         """
         if not embeddings1_unmatched or not embeddings2_unmatched:
             return [], 0.0
 
+        start = time.perf_counter()
         fuzzy_matches = prof_common.get_fuzzy_matches(threshold)
+        greedy_time = time.perf_counter() - start
+
+        if matching != 'greedy':
+            greedy_matches = fuzzy_matches
+            start = time.perf_counter()
+            if matching == 'hungarian':
+                fuzzy_matches = prof_common.get_assignment_matches(threshold)
+            elif matching == 'sparse':
+                fuzzy_matches = prof_common.get_sparse_assignment_matches(threshold, top_k)
+            else:
+                raise ValueError(f"Unknown matching {matching}, expected 'greedy', 'hungarian' or 'sparse'")
+            matching_time = time.perf_counter() - start
+
+            print(f"Matching {len(embeddings1_unmatched)}x{len(embeddings2_unmatched)} unmatched functions: "
+                  f"greedy {len(greedy_matches)} matches, total similarity {sum(score for _, _, score in greedy_matches):.4f}, {greedy_time * 1000:.2f} ms; "
+                  f"{matching} {len(fuzzy_matches)} matches, total similarity {sum(score for _, _, score in fuzzy_matches):.4f}, {matching_time * 1000:.2f} ms")
         
         coverage_1 = len(fuzzy_matches) / len(embeddings1_unmatched) if embeddings1_unmatched else 0
         coverage_2 = len(fuzzy_matches) / len(embeddings2_unmatched) if embeddings2_unmatched else 0
@@ -38,67 +62,37 @@ class BinaryHandler:
 
         return fuzzy_matches, weighted_avg_similarity
 
-    def find_best_match(similarity_matrix, functions1, functions2):
+    def top_k_candidates(row_indices, row_scores, keys1, keys2):
         """
-        Finds the best match between two sets of functions based on similarity.
-        
-        Args:
-        - similarity_matrix (numpy.ndarray): Similarity matrix between the functions.
-        - functions1 (list): List of functions from the first file.
-        - functions2 (list): List of functions from the second file.
+        Converts the per-row top-k of a similarity matrix into candidate lists.
 
-        Returns:
-        - tuple: The best match with the function names and maximum similarity.
+        :param row_indices: Column indices returned by PairWiseSimilarity.top_k_rows or tiled_top_k
+        :param row_scores: Scores of the same shape
+        :param keys1: Function key of every row
+        :param keys2: Function key of every column
+        :return: Dictionary function key of keys1 -> list of (function key of keys2, similarity), best first
         """
-        # Finds max similarity
-        max_similarity = np.amax(similarity_matrix)
-        r_list, c_list = np.where(similarity_matrix == max_similarity)
-
-        if len(r_list) == 0 or len(c_list) == 0 or len(r_list) != len(c_list):
-            print("[find_best_match] max found but r_list and c_list are empty or mismatched")
-            return None, None, None
-
-        r, c = r_list[0], c_list[0]
+        return {
+            key1: [(keys2[c], float(score)) for c, score in zip(indices, scores)]
+            for key1, indices, scores in zip(keys1, row_indices, row_scores)
+        }
 
-        return functions1[r]['function_name'], functions2[c]['function_name'], max_similarity
-
-    def find_best_match_unmatched(similarity_matrix, embeddings1, embeddings2):
+    def best_match_from_candidates(row_indices, row_scores):
         """
-        Finds the best match between two sets of embeddings based on the similarity matrix.
-        
-        Parameters:
-        - similarity_matrix (np.ndarray): Similarity matrix of size (n, m),
-        where n is the number of embeddings in embeddings1 and m is the number of embeddings in embeddings2.
-        - embeddings1 (list): List of embeddings from the first set.
-        - embeddings2 (list): List of embeddings from the second set.
+        Global maximum of a similarity matrix from its per-row top-k, without scanning it again.
 
-        Returns:
-        - best_matches (list of tuples): List of tuples, where each tuple contains the index of the embedding
-        from embeddings1 and the index of the embedding from embeddings2 that represent the best match.
-        - max_similarity (float): The maximum similarity found.
-        """
-        num_embeddings1 = similarity_matrix.shape[0]
-        num_embeddings2 = similarity_matrix.shape[1]
+        The first candidate of a row is its first maximum, and np.argmax takes the first row, so
+        the position is the first maximum in row-major order as with np.where.
 
-        # Finds max similarity
-        max_similarity = np.amax(similarity_matrix)
-
-        # Finds the positions (rows, columns) where the maximum value is located
-        r_list, c_list = np.where(similarity_matrix == max_similarity)
-
-        # Verifies that the row and column lists are valid and have the same number of elements
-        if len(r_list) == 0 or len(c_list) == 0 or len(r_list) != len(c_list):
-            print("[find_best_match] max found but r_list and c_list are empty or mismatched")
-            return None, None
-
-        # Taking first match
-        r, c = r_list[0], c_list[0]
-
-        # Return the best matches and maximum similarity.
-        best_matches = [(r, c)]
-        return best_matches, max_similarity
+        :return: Tuple (row, column, similarity), or None if there are no candidates
+        """
+        if row_scores.shape[0] == 0 or row_scores.shape[1] == 0:
+            return None
+        r = int(np.argmax(row_scores[:, 0]))
+        return r, int(row_indices[r, 0]), row_scores[r, 0]
 
-    def calculate_bfs_dfs_similarities(functions1, functions2):
+    def calculate_bfs_dfs_similarities(functions1, functions2, include_unmatched=True):
+        # With include_unmatched False only the common functions are compared, see count_bfs_dfs_similarities_unmatched
         bfs_dfs_similarities_common = []
         for common_func_key in functions1.keys() & functions2.keys():
             func1 = functions1[common_func_key]
@@ -110,6 +104,9 @@ class BinaryHandler:
             bfs_dfs_similarities_common.append((common_func_key, bfs_dfs_similarity))
 
         bfs_dfs_similarities_unmatched = []
+        if not include_unmatched:
+            return bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched
+
         unmatched_functions1 = [functions1[k] for k in functions1.keys() - functions2.keys()]
         unmatched_functions2 = [functions2[k] for k in functions2.keys() - functions1.keys()]
 
@@ -123,6 +120,211 @@ class BinaryHandler:
         
         return bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched
 
+    def count_bfs_dfs_similarities_unmatched(functions1, functions2, threshold=0.2):
+        """
+        Counts the pairs of unmatched functions whose BFS/DFS similarity is above threshold, as
+        calculate_final_similarities does on the list of calculate_bfs_dfs_similarities, without
+        building that list.
+
+        Every function becomes the node counts of its BFS and DFS path graphs, and the n x m scores
+        are computed with NumPy broadcasting from path_graph_similarity. Only the rows and columns
+        of functions whose results repeat an address go through results_similarity.
+
+        :param functions1: Functions of the first file, indexed by key
+        :param functions2: Functions of the second file, indexed by key
+        :param threshold: Similarity a pair must exceed to be counted
+        :return: Tuple (pairs above threshold, total pairs)
+        """
+        unmatched_functions1 = [functions1[k] for k in functions1.keys() - functions2.keys()]
+        unmatched_functions2 = [functions2[k] for k in functions2.keys() - functions1.keys()]
+        if not unmatched_functions1 or not unmatched_functions2:
+            return 0, 0
+
+        scores = BinaryHandler.bfs_dfs_similarity_matrix(unmatched_functions1, unmatched_functions2)
+        return int(np.count_nonzero(scores > threshold)), scores.size
+
+    def bfs_dfs_similarity_matrix(unmatched_functions1, unmatched_functions2):
+        # Scores of compute_bfs_dfs_similarity_as_graph for every pair of the two lists, see count_bfs_dfs_similarities_unmatched
+        scores = np.zeros((len(unmatched_functions1), len(unmatched_functions2)))
+        for result_key in ('bfs_result', 'dfs_result'):
+            nodes1 = BinaryHandler.path_graph_sizes(unmatched_functions1, result_key)
+            nodes2 = BinaryHandler.path_graph_sizes(unmatched_functions2, result_key)
+
+            a = nodes1[:, None]
+            b = nodes2[None, :]
+            largest = np.maximum(np.maximum(a, b), 1)
+            similarity = np.where((a > 0) & (b > 0), np.clip(1 - 2 * np.abs(a - b) / largest, 0, 1), 0.0)
+
+            for i in np.nonzero(nodes1 < 0)[0]:
+                similarity[i, :] = [BinaryHandler.results_similarity(unmatched_functions1[i][result_key], f[result_key]) for f in unmatched_functions2]
+            # Rows already filled above are skipped
+            path_rows = np.nonzero(nodes1 >= 0)[0]
+            for j in np.nonzero(nodes2 < 0)[0]:
+                similarity[path_rows, j] = [BinaryHandler.results_similarity(unmatched_functions1[i][result_key], unmatched_functions2[j][result_key]) for i in path_rows]
+
+            scores += similarity
+
+        scores /= 2
+        return scores
+
+    def calculate_cfg_similarities(functions1, functions2, include_unmatched=True):
+        """
+        Same lists as calculate_bfs_dfs_similarities, scored by the Weisfeiler-Lehman kernel of the
+        stored block-level CFGs (CFGKernel) instead of the edit distance of the BFS/DFS paths.
+        Pairs where a function has no stored CFG keep the BFS/DFS similarity.
+        """
+        bfs_dfs_similarities_common = []
+        for common_func_key in functions1.keys() & functions2.keys():
+            func1 = functions1[common_func_key]
+            func2 = functions2[common_func_key]
+            if func1.get('cfg_features') is not None and func2.get('cfg_features') is not None:
+                similarity = CFGKernel.similarity(func1['cfg_features'], func2['cfg_features'])
+            else:
+                similarity = BinaryHandler.compute_bfs_dfs_similarity_as_graph(
+                    func1['bfs_result'], func1['dfs_result'],
+                    func2['bfs_result'], func2['dfs_result']
+                )
+            bfs_dfs_similarities_common.append((common_func_key, similarity))
+
+        bfs_dfs_similarities_unmatched = []
+        if not include_unmatched:
+            return bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched
+
+        unmatched_functions1 = [functions1[k] for k in functions1.keys() - functions2.keys()]
+        unmatched_functions2 = [functions2[k] for k in functions2.keys() - functions1.keys()]
+        scores, _ = BinaryHandler.cfg_similarity_matrix(unmatched_functions1, unmatched_functions2)
+        for i, unmatched_func in enumerate(unmatched_functions1):
+            for j, other_func in enumerate(unmatched_functions2):
+                bfs_dfs_similarities_unmatched.append(((unmatched_func['function_name'], other_func['function_name']), float(scores[i, j])))
+
+        return bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched
+
+    def count_cfg_similarities_common(functions1, functions2, bfs_dfs_similarities_common,
+                                      threshold=CFGKernel.COMMON_THRESHOLD, fallback_threshold=0.8):
+        """
+        Counts the common functions of calculate_cfg_similarities above threshold. A kernel score
+        is compared with threshold, a BFS/DFS score (a function without a stored CFG) with
+        fallback_threshold, the threshold of calculate_final_similarities.
+
+        :return: Tuple (functions above threshold, total functions)
+        """
+        above_threshold = 0
+        for common_func_key, similarity in bfs_dfs_similarities_common:
+            kernel_scored = functions1[common_func_key].get('cfg_features') is not None and functions2[common_func_key].get('cfg_features') is not None
+            if similarity > (threshold if kernel_scored else fallback_threshold):
+                above_threshold += 1
+        return above_threshold, len(bfs_dfs_similarities_common)
+
+    def count_cfg_similarities_unmatched(functions1, functions2, threshold=CFGKernel.UNMATCHED_THRESHOLD, fallback_threshold=0.2):
+        # count_bfs_dfs_similarities_unmatched with the scores of calculate_cfg_similarities, kernel
+        # scores against threshold and BFS/DFS scores against fallback_threshold
+        unmatched_functions1 = [functions1[k] for k in functions1.keys() - functions2.keys()]
+        unmatched_functions2 = [functions2[k] for k in functions2.keys() - functions1.keys()]
+        if not unmatched_functions1 or not unmatched_functions2:
+            return 0, 0
+
+        scores, kernel_scored = BinaryHandler.cfg_similarity_matrix(unmatched_functions1, unmatched_functions2)
+        above_threshold = np.count_nonzero(scores[kernel_scored] > threshold) + np.count_nonzero(scores[~kernel_scored] > fallback_threshold)
+        return int(above_threshold), scores.size
+
+    def cfg_similarity_matrix(unmatched_functions1, unmatched_functions2):
+        """
+        CFG kernel similarity of every pair of the two lists, one sparse matrix product. Pairs
+        where a function has no stored CFG get the BFS/DFS similarity, only those are computed.
+
+        :return: Tuple (similarity matrix, boolean matrix of the pairs scored by the kernel)
+        """
+        scores, has_cfg1, has_cfg2 = CFGKernel.similarity_matrix(unmatched_functions1, unmatched_functions2)
+        # float64 like the BFS/DFS scores written into it
+        scores = scores.astype(np.float64)
+        if not has_cfg1.all():
+            scores[~has_cfg1, :] = BinaryHandler.bfs_dfs_similarity_matrix(
+                [f for f, has_cfg in zip(unmatched_functions1, has_cfg1) if not has_cfg], unmatched_functions2
+            )
+        if not has_cfg2.all():
+            scores[np.ix_(has_cfg1, ~has_cfg2)] = BinaryHandler.bfs_dfs_similarity_matrix(
+                [f for f, has_cfg in zip(unmatched_functions1, has_cfg1) if has_cfg],
+                [f for f, has_cfg in zip(unmatched_functions2, has_cfg2) if not has_cfg]
+            )
+        return scores, np.outer(has_cfg1, has_cfg2)
+
+    def precompute_graph_similarities(functions1, functions2, executor, include_unmatched=True, cfg_fallback_only=False):
+        """
+        Computes with a GraphSimilarityExecutor every graph similarity that calculate_bfs_dfs_similarities
+        (and count_bfs_dfs_similarities_unmatched) would run through networkx, and stores it in
+        BinaryHandler.similarity_cache. Every pair of shapes missing from the cache is submitted once.
+
+        :param functions1: Functions of the first file, indexed by key
+        :param functions2: Functions of the second file, indexed by key
+        :param executor: GraphSimilarityExecutor
+        :param include_unmatched: Also precompute the pairs of unmatched functions
+        :param cfg_fallback_only: Only the pairs calculate_cfg_similarities scores with BFS/DFS,
+                                  where a function has no stored CFG
+        :return: Tuple (tasks submitted, tasks that timed out and got the fallback score)
+        """
+        cache = BinaryHandler.similarity_cache
+        jobs = {}
+
+        def shapes(functions, result_key):
+            # Results of every distinct shape, keyed by structural signature
+            by_signature = {}
+            for function in functions:
+                by_signature.setdefault(BinaryHandler.structural_signature(function[result_key]), function[result_key])
+            return by_signature
+
+        def add_job(signature1, results1, signature2, results2):
+            if signature1.startswith('path:') and signature2.startswith('path:'):
+                return
+            key = GraphSimilarityCache.pair_key(signature1, signature2)
+            if key not in jobs and not cache.contains(signature1, signature2):
+                jobs[key] = (results1, results2)
+
+        def without_cfg(function):
+            return function.get('cfg_features') is None
+
+        unmatched_functions1 = [functions1[k] for k in functions1.keys() - functions2.keys()]
+        unmatched_functions2 = [functions2[k] for k in functions2.keys() - functions1.keys()]
+        if cfg_fallback_only:
+            # Rows without a CFG against every column, every row against the columns without a CFG
+            unmatched_blocks = [
+                ([f for f in unmatched_functions1 if without_cfg(f)], unmatched_functions2),
+                (unmatched_functions1, [f for f in unmatched_functions2 if without_cfg(f)]),
+            ]
+        else:
+            unmatched_blocks = [(unmatched_functions1, unmatched_functions2)]
+
+        for result_key in ('bfs_result', 'dfs_result'):
+            for common_func_key in functions1.keys() & functions2.keys():
+                func1 = functions1[common_func_key]
+                func2 = functions2[common_func_key]
+                if cfg_fallback_only and not without_cfg(func1) and not without_cfg(func2):
+                    continue
+                add_job(BinaryHandler.structural_signature(func1[result_key]), func1[result_key],
+                        BinaryHandler.structural_signature(func2[result_key]), func2[result_key])
+
+            if include_unmatched:
+                for block1, block2 in unmatched_blocks:
+                    shapes1 = shapes(block1, result_key)
+                    shapes2 = shapes(block2, result_key)
+                    for signature1, results1 in shapes1.items():
+                        for signature2, results2 in shapes2.items():
+                            add_job(signature1, results1, signature2, results2)
+
+        if not jobs:
+            return 0, 0
+
+        keys = list(jobs.keys())
+        scores, timed_out = executor.map([jobs[key] for key in keys])
+        timed_out = set(timed_out)
+        for i, (key, score) in enumerate(zip(keys, scores)):
+            cache.put(key[0], key[1], score, persist=i not in timed_out)
+        return len(keys), len(timed_out)
+
+    def path_graph_sizes(functions, result_key):
+        # Node count of the path graph of every function, -1 when it is not a simple path
+        sizes = [BinaryHandler.path_graph_size(function[result_key]) for function in functions]
+        return np.array([size if size is not None else -1 for size in sizes], dtype=np.float64)
+
     def normalize_similarity(value):
         """
         Normalizes the similarity value between 0 and 1.
@@ -172,6 +374,68 @@ class BinaryHandler:
         # Normalizzazione da 0 a 1
         return BinaryHandler.normalize_similarity(similarity)
 
+    def graph_from_results(results):
+        # Path graph through the addresses of a BFS/DFS result, in visit order
+        G = nx.Graph()
+        for idx, node in enumerate(results):
+            G.add_node(node)
+            if idx > 0:
+                G.add_edge(results[idx - 1], node)
+        return G
+
+    def path_graph_size(results):
+        """
+        Number of nodes of the graph built by graph_from_results, or None when an address repeats
+        (the graph is then not a simple path).
+        """
+        nodes = len(set(results))
+        return nodes if nodes == len(results) else None
+
+    def path_graph_similarity(nodes1, nodes2):
+        """
+        Exact graph_similarity of two unlabeled path graphs with nodes1 and nodes2 nodes.
+
+        The edit distance between P_a and P_b (a <= b) is 2 * (b - a): node and edge counts both
+        differ by b - a, which bounds it from below, and P_a is a subgraph of P_b, so inserting
+        b - a nodes and b - a edges reaches it.
+
+        :return: Normalized similarity score
+        """
+        if nodes1 == 0 or nodes2 == 0:
+            return 0
+
+        edit_distance = 2 * abs(nodes1 - nodes2)
+        return BinaryHandler.normalize_similarity(1 - edit_distance / max(nodes1, nodes2))
+
+    def structural_signature(results):
+        """
+        Canonical signature of the shape of the graph built from a BFS/DFS result: the number of
+        nodes for a simple path, node and edge counts plus the Weisfeiler-Lehman hash otherwise.
+        """
+        nodes = BinaryHandler.path_graph_size(results)
+        if nodes is not None:
+            return f"path:{nodes}"
+
+        G = BinaryHandler.graph_from_results(results)
+        return f"wl:{G.number_of_nodes()}:{G.number_of_edges()}:{nx.weisfeiler_lehman_graph_hash(G)}"
+
+    def results_similarity(results1, results2):
+        """
+        Similarity of the graphs built from two BFS/DFS results: closed form when both are simple
+        paths, networkx graph edit distance otherwise. Shapes already compared are read from
+        BinaryHandler.similarity_cache.
+        """
+        def compute():
+            nodes1 = BinaryHandler.path_graph_size(results1)
+            nodes2 = BinaryHandler.path_graph_size(results2)
+            if nodes1 is not None and nodes2 is not None:
+                return BinaryHandler.path_graph_similarity(nodes1, nodes2)
+            return BinaryHandler.graph_similarity(BinaryHandler.graph_from_results(results1), BinaryHandler.graph_from_results(results2))
+
+        return BinaryHandler.similarity_cache.get_or_compute(
+            BinaryHandler.structural_signature(results1), BinaryHandler.structural_signature(results2), compute
+        )
+
     def compute_bfs_dfs_similarity_as_graph(bfs_result1, dfs_result1, bfs_result2, dfs_result2):
         """
         Calculates the similarity between the BFS and DFS results of two functions using a graph-based approach.
@@ -182,39 +446,45 @@ class BinaryHandler:
         :param dfs_result2: DFS result of the second function (list of hexadecimal strings)
         :return: Similarity score
         """
-        def create_graph_from_results(results):
-            G = nx.Graph()
-            for idx, node in enumerate(results):
-                G.add_node(node)
-                if idx > 0:
-                    G.add_edge(results[idx - 1], node)
-            return G
+        # Calculate graph similarities using the edit distance of the BFS and DFS path graphs
+        bfs_similarity = BinaryHandler.results_similarity(bfs_result1, bfs_result2)
+        dfs_similarity = BinaryHandler.results_similarity(dfs_result1, dfs_result2)
 
-        # Create graphs from BFS and DFS results
-        G1_bfs = create_graph_from_results(bfs_result1)
-        G2_bfs = create_graph_from_results(bfs_result2)
-        G1_dfs = create_graph_from_results(dfs_result1)
-        G2_dfs = create_graph_from_results(dfs_result2)
+        # Combine similarities
+        return (bfs_similarity + dfs_similarity) / 2
 
-        # Calculate graph similarities using edit distance
-        bfs_similarity = BinaryHandler.graph_similarity(G1_bfs, G2_bfs)
-        dfs_similarity = BinaryHandler.graph_similarity(G1_dfs, G2_dfs)
+    def compute_bfs_dfs_similarity_as_graph_nx(bfs_result1, dfs_result1, bfs_result2, dfs_result2):
+        """
+        Reference version of compute_bfs_dfs_similarity_as_graph running networkx's graph edit
+        distance on every graph, used to check the closed form.
+        """
+        bfs_similarity = BinaryHandler.graph_similarity(BinaryHandler.graph_from_results(bfs_result1), BinaryHandler.graph_from_results(bfs_result2))
+        dfs_similarity = BinaryHandler.graph_similarity(BinaryHandler.graph_from_results(dfs_result1), BinaryHandler.graph_from_results(dfs_result2))
 
-        # Combine similarities
         return (bfs_similarity + dfs_similarity) / 2
 
-    def calculate_final_similarities(bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched, common_similarity_threshold=0.8, unmatched_similarity_threshold=0.2):
-        # Counts the functions with high similarity in common functions
-        high_similarity_common = sum(1 for _, similarity in bfs_dfs_similarities_common if similarity > common_similarity_threshold)
+    def calculate_final_similarities(bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched, common_similarity_threshold=0.8, unmatched_similarity_threshold=0.2, unmatched_counts=None, common_counts=None):
+        # unmatched_counts, when given, is the (above threshold, total) tuple of count_bfs_dfs_similarities_unmatched
+        # computed with unmatched_similarity_threshold, and replaces bfs_dfs_similarities_unmatched.
+        # common_counts likewise replaces bfs_dfs_similarities_common (count_cfg_similarities_common)
+
+        if common_counts is not None:
+            high_similarity_common, total_common_functions = common_counts
+        else:
+            # Counts the functions with high similarity in common functions
+            high_similarity_common = sum(1 for _, similarity in bfs_dfs_similarities_common if similarity > common_similarity_threshold)
 
-        # Counts the functions with high similarity in unmatched functions
-        high_similarity_unmatched = sum(1 for _, similarity in bfs_dfs_similarities_unmatched if similarity > unmatched_similarity_threshold)
+            # Total number of common functions analyzed
+            total_common_functions = len(bfs_dfs_similarities_common)
 
-        # Total number of common functions analyzed
-        total_common_functions = len(bfs_dfs_similarities_common)
+        if unmatched_counts is not None:
+            high_similarity_unmatched, total_unmatched_functions = unmatched_counts
+        else:
+            # Counts the functions with high similarity in unmatched functions
+            high_similarity_unmatched = sum(1 for _, similarity in bfs_dfs_similarities_unmatched if similarity > unmatched_similarity_threshold)
 
-        # Total number of unmatched functions analyzed
-        total_unmatched_functions = len(bfs_dfs_similarities_unmatched)
+            # Total number of unmatched functions analyzed
+            total_unmatched_functions = len(bfs_dfs_similarities_unmatched)
 
         # Calculate the final similarity for common functions
         final_similarity_common = (high_similarity_common / total_common_functions) if total_common_functions > 0 else 0.0
@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+from DatabaseHandler import DatabaseHandler
+from EmbeddedHandler import EmbeddedHandler
+from EmbeddingCache import EmbeddingCache
+from AnnIndex import AnnIndex
+
+# Builds the ANN index over the function embeddings of a reference database and measures its
+# recall@k against exact search, on the functions of a query database when one is given.
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 BuildAnnIndex.py <reference database> [<query database>]")
+        sys.exit(1)
+
+    reference_db = sys.argv[1]
+    query_db = sys.argv[2] if len(sys.argv) > 2 else None
+    embedding_storage = 'float32'  # Must match the embedding_storage of CallerSim
+    n_lists = None  # None uses about sqrt(number of functions) lists
+    n_probe = 8
+    k = 10
+
+    embedding_cache = EmbeddingCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache.db'), EmbeddedHandler.model_files())
+
+    db_handler = DatabaseHandler(reference_db, reference_db)
+    data = db_handler.fetch_all_data(reference_db)
+    store = EmbeddedHandler.load_embedding_store(data, reference_db, embedding_storage, cache=embedding_cache)
+
+    index = AnnIndex.from_store(store, n_lists=n_lists, n_probe=n_probe)
+    index.save(reference_db, embedding_cache.model_hash)
+
+    if query_db is not None:
+        query_data = db_handler.fetch_all_data(query_db)
+        query_store = EmbeddedHandler.load_embedding_store(query_data, query_db, embedding_storage, cache=embedding_cache)
+        queries = query_store.vectors(list(range(len(query_store.keys))))
+    else:
+        sample = np.random.default_rng(0).choice(len(store.keys), min(1000, len(store.keys)), replace=False)
+        queries = store.vectors(sample)
+
+    for probes in sorted({1, n_probe, 2 * n_probe}):
+        index.recall_at_k(queries, k, probes)
+
+    embedding_cache.print_stats()
+    embedding_cache.close()
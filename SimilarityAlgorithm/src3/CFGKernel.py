@@ -0,0 +1,105 @@
+import hashlib
+import numpy as np
+from scipy.sparse import csr_matrix
+
+class CFGKernel:
+    """
+    Weisfeiler-Lehman subtree features of the block-level CFGs stored at ingest (cfg_edges column
+    of function_info, see GraphManager.edge_list in the disassembly pipeline).
+
+    Every block starts with the label (out degree, in degree); each iteration relabels it with
+    its label and the sorted labels of its successors and predecessors. The labels of all
+    iterations are hashed into DIMENSION buckets and counted, and the count vector is
+    L2-normalized, so the similarity of two CFGs is the sparse dot product of their vectors,
+    between 0 and 1 and 1 for isomorphic graphs.
+    """
+
+    ITERATIONS = 3
+    DIMENSION = 1 << 20
+
+    # Thresholds of the kernel scores in BinaryHandler.count_cfg_similarities_common/_unmatched, which
+    # run higher than the BFS/DFS ones (0.8 and 0.2): on random CFGs of 2-30 blocks, 87% of the
+    # unrelated pairs score above 0.2, 3.6% above 0.7 and 0.15% above 0.8.
+    COMMON_THRESHOLD = 0.8
+    UNMATCHED_THRESHOLD = 0.7
+
+    def label_hash(label):
+        # Stable across processes and runs, unlike hash()
+        return int.from_bytes(hashlib.blake2b(label.encode(), digest_size=8).digest(), 'little')
+
+    def feature_vector(cfg_edges, iterations=ITERATIONS):
+        """
+        :param cfg_edges: Dictionary {'nodes': block addresses, 'edges': [source index, destination index] pairs}
+        :param iterations: Number of Weisfeiler-Lehman relabelings
+        :return: Tuple (sorted bucket indices, normalized float32 values), or None without a CFG
+        """
+        if not cfg_edges or not cfg_edges.get('nodes'):
+            return None
+
+        n = len(cfg_edges['nodes'])
+        successors = [[] for _ in range(n)]
+        predecessors = [[] for _ in range(n)]
+        for source, destination in cfg_edges['edges']:
+            successors[source].append(destination)
+            predecessors[destination].append(source)
+
+        labels = [f"{len(successors[i])}:{len(predecessors[i])}" for i in range(n)]
+        buckets = [CFGKernel.label_hash(f"0|{label}") % CFGKernel.DIMENSION for label in labels]
+        for iteration in range(1, iterations + 1):
+            labels = [
+                "%x" % CFGKernel.label_hash(f"{labels[i]}|{sorted(labels[j] for j in successors[i])}|{sorted(labels[j] for j in predecessors[i])}")
+                for i in range(n)
+            ]
+            buckets.extend(CFGKernel.label_hash(f"{iteration}|{label}") % CFGKernel.DIMENSION for label in labels)
+
+        indices, counts = np.unique(np.array(buckets, dtype=np.int64), return_counts=True)
+        values = counts.astype(np.float32)
+        values /= np.linalg.norm(values)
+        return indices.astype(np.int32), values
+
+    def attach_features(data, iterations=ITERATIONS):
+        """
+        Adds the 'cfg_features' vector of every function of data (None when it has no stored CFG).
+
+        :param data: Data returned by DatabaseHandler.fetch_all_data
+        :return: Number of functions with a CFG
+        """
+        count = 0
+        for entry in data['info']:
+            for function in entry['functions']:
+                function['cfg_features'] = CFGKernel.feature_vector(function.get('cfg_edges'), iterations)
+                if function['cfg_features'] is not None:
+                    count += 1
+        return count
+
+    def similarity(features1, features2):
+        # Sparse dot product of two normalized feature vectors, float32 rounding can exceed 1 by an ulp
+        indices1, values1 = features1
+        indices2, values2 = features2
+        _, positions1, positions2 = np.intersect1d(indices1, indices2, assume_unique=True, return_indices=True)
+        return min(1.0, float(np.dot(values1[positions1], values2[positions2])))
+
+    def feature_matrix(functions):
+        """
+        :param functions: List of functions with 'cfg_features'
+        :return: Tuple (CSR matrix with one row per function, boolean mask of the functions with a CFG)
+        """
+        has_features = np.array([function.get('cfg_features') is not None for function in functions], dtype=bool)
+        features = [function['cfg_features'] for function in functions if function.get('cfg_features') is not None]
+        lengths = np.zeros(len(functions) + 1, dtype=np.int64)
+        lengths[1:][has_features] = [len(indices) for indices, _ in features]
+        indices = np.concatenate([indices for indices, _ in features]) if features else np.zeros(0, dtype=np.int32)
+        values = np.concatenate([values for _, values in features]) if features else np.zeros(0, dtype=np.float32)
+        matrix = csr_matrix((values, indices, np.cumsum(lengths)), shape=(len(functions), CFGKernel.DIMENSION))
+        return matrix, has_features
+
+    def similarity_matrix(functions1, functions2):
+        """
+        All-pairs CFG similarities as one sparse matrix product.
+
+        :return: Tuple (dense float matrix of shape (len(functions1), len(functions2)), mask of
+                 functions1 with a CFG, mask of functions2 with a CFG). Pairs without a CFG are 0.
+        """
+        matrix1, has_features1 = CFGKernel.feature_matrix(functions1)
+        matrix2, has_features2 = CFGKernel.feature_matrix(functions2)
+        return np.minimum((matrix1 @ matrix2.T).toarray(), 1.0), has_features1, has_features2
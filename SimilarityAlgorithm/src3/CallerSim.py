@@ -22,6 +22,13 @@ from GraphHandler import GraphHandler
 from BinaryHandler import BinaryHandler
 from HotspotHandler import HotspotHandler
 from EmbeddedHandler import EmbeddedHandler
+from EmbeddingCache import EmbeddingCache
+from GraphSimilarityCache import GraphSimilarityCache
+from GraphSimilarityExecutor import GraphSimilarityExecutor
+from CFGKernel import CFGKernel
+from ReferenceCorpus import ReferenceCorpus
+from FileSignature import FileSignatureIndex
+from binsim_utility import get_ids_from_functions
 from OutputHandler import OutputPrinter
 from MetricsHandler import MetricsHandler
 
@@ -29,7 +36,25 @@ def generate_function_key(function):
     #return (function['function_name'], function['entry_point'])
     return function['function_name']
 
-def compare_binary_files_and_functions(data1, data2):
+def compare_binary_files_and_functions(data1, data2, file_features2=None, matching='greedy', top_k=5, candidate_files=None, bfs_dfs_mode='list', graph_executor=None, structure_similarity='bfs_dfs'):
+    # bfs_dfs_mode 'vectorized' only keeps the number of unmatched pairs with a BFS/DFS similarity
+    # above the threshold of calculate_final_similarities, instead of the list of every pair.
+    # graph_executor, a GraphSimilarityExecutor, computes the graph similarities networkx is needed
+    # for in parallel, with a hard deadline per task, before the BFS/DFS comparison.
+    # structure_similarity 'cfg_kernel' scores the function pairs with the Weisfeiler-Lehman kernel
+    # of their stored CFGs (see CFGKernel.attach_features) instead of their BFS/DFS paths.
+    # candidate_files optionally maps the id of every file in data1 to the ids of the files of
+    # data2 it is compared with (see FileSignatureIndex.rank), by default every pair is compared.
+    # file_features2 maps the id of every file in data2 to its precomputed structures,
+    # see ReferenceCorpus. When it is missing they are computed here.
+    if file_features2 is None:
+        file_features2 = {entry2['id']: ReferenceCorpus.compute_file_features(entry2) for entry2 in data2['info']}
+
+    # Embeddings moved into an EmbeddingStore by EmbeddedHandler.load_embedding_store
+    store1 = data1.get('embedding_store')
+    store2 = data2.get('embedding_store')
+    use_stores = store1 is not None and store2 is not None
+
     all_comparisons = []
 
     for entry1 in data1['info']:
@@ -57,18 +82,20 @@ def compare_binary_files_and_functions(data1, data2):
         pprint.pprint(component_sizes)
         print("-" * 40)
 
+        # Extract and build structures for the first file
+        file_features1 = ReferenceCorpus.compute_file_features(entry1)
+        functions1 = file_features1['functions']
+        component_sizes1 = file_features1['component_sizes']
+
         for entry2 in data2['info']:
-            print(f"Comparing file from db1: {entry1['filename']} with file from db2: {entry2['filename']}")
+            if candidate_files is not None and entry2['id'] not in candidate_files[entry1['id']]:
+                continue
 
-            # Extract and build structures for the first file
-            call_graph1 = entry1['call_graph']
-            functions1 = {generate_function_key(func): func for func in entry1['functions']}
-            component_sizes1 = GraphHandler.compute_left_connected_components(call_graph1, entry1['functions'])
+            print(f"Comparing file from db1: {entry1['filename']} with file from db2: {entry2['filename']}")
 
-            # Extract and build structures for the second file
-            call_graph2 = entry2['call_graph']
-            functions2 = {generate_function_key(func): func for func in entry2['functions']}
-            component_sizes2 = GraphHandler.compute_left_connected_components(call_graph2, entry2['functions'])
+            # Structures for the second file are built once per database
+            functions2 = file_features2[entry2['id']]['functions']
+            component_sizes2 = file_features2[entry2['id']]['component_sizes']
 
             # Find common and unmatched functions
             common_functions_keys = functions1.keys() & functions2.keys()
@@ -77,35 +104,46 @@ def compare_binary_files_and_functions(data1, data2):
             unmatched_functions2 = [functions2[k] for k in functions2.keys() - common_functions_keys]
 
             embedding_comparisons = []
+            top_k_candidates_common = {}
+            top_k_candidates_unmatched = {}
             max_similarity_common = (None, None, 0)
             weighted_avg_similarity_common = 0.0
 
             if common_functions:
-                embeddings1_common = [(str(i), [functions1[func_key]['embeddeds']]) for i, func_key in enumerate(common_functions_keys)]
-                embeddings2_common = [(str(i), [functions2[func_key]['embeddeds']]) for i, func_key in enumerate(common_functions_keys)]
-                
-                prof_common = PairWiseSimilarity(embeddings1_common, embeddings2_common, None)
-                
-                # Calculate max similarity for common functions with matrices
-                similarity_matrix = np.zeros((len(embeddings1_common), len(embeddings2_common)))
-                for i in range(len(embeddings1_common)):
-                    for j in range(len(embeddings2_common)):
-                        similarity_matrix[i, j] = prof_common._compute_similarity(embeddings1_common[i][1], embeddings2_common[j][1])
-                
-                best_match = BinaryHandler.find_best_match(similarity_matrix, common_functions, common_functions)
-                if best_match:
-                    max_similarity_common = best_match
-                
-                weighted_avg_similarity_common = np.mean(similarity_matrix) if similarity_matrix.size > 0 else 0
-
-                for i, func_key in enumerate(common_functions_keys):
-                    embedding1 = embeddings1_common[i][1]
-                    embedding2 = embeddings2_common[i][1]
-                    similarity = prof_common._compute_similarity(embedding1, embedding2)
-                    embedding_comparisons.append((func_key, similarity))
-
-            embeddings1_unmatched = [(func_key, functions1[func_key]['embeddeds']) for func_key in functions1.keys() - common_functions_keys]
-            embeddings2_unmatched = [(func_key, functions2[func_key]['embeddeds']) for func_key in functions2.keys() - common_functions_keys]
+                # Only the diagonal (each function with itself), the mean and the max of the common
+                # similarity matrix are used, they are computed without allocating it
+                common_keys = list(common_functions_keys)
+                if use_stores:
+                    # Similarities computed on the stored (possibly quantized) embeddings
+                    rows1 = store1.rows(entry1['id'], common_keys)
+                    rows2 = store2.rows(entry2['id'], common_keys)
+                    statistics = store1.aggregate_similarity(rows1, store2, rows2, argmax=False)
+                    top_common = store1.top_k(rows1, store2, rows2, top_k)
+                else:
+                    common_embeddings1 = [functions1[func_key]['embeddeds'] for func_key in common_keys]
+                    common_embeddings2 = [functions2[func_key]['embeddeds'] for func_key in common_keys]
+                    statistics = PairWiseSimilarity.aggregate_statistics(common_embeddings1, common_embeddings2, argmax=False)
+                    top_common = PairWiseSimilarity.tiled_top_k(common_embeddings1, common_embeddings2, top_k)
+
+                # Top-k candidates of every common function, the global best match is the best of their first candidates
+                top_k_candidates_common = BinaryHandler.top_k_candidates(top_common['row_indices'], top_common['row_scores'], common_keys, common_keys)
+                best_match_common = BinaryHandler.best_match_from_candidates(top_common['row_indices'], top_common['row_scores'])
+                if best_match_common is not None:
+                    r, c, max_similarity = best_match_common
+                    max_similarity_common = (common_functions[r]['function_name'], common_functions[c]['function_name'], max_similarity)
+
+                weighted_avg_similarity_common = statistics['mean']
+
+                for i, func_key in enumerate(common_keys):
+                    embedding_comparisons.append((func_key, float(statistics['diagonal'][i])))
+
+            if use_stores:
+                # Only the keys are needed, the embeddings are read from the stores
+                embeddings1_unmatched = [(func_key, None) for func_key in functions1.keys() - common_functions_keys]
+                embeddings2_unmatched = [(func_key, None) for func_key in functions2.keys() - common_functions_keys]
+            else:
+                embeddings1_unmatched = [(func_key, functions1[func_key]['embeddeds']) for func_key in functions1.keys() - common_functions_keys]
+                embeddings2_unmatched = [(func_key, functions2[func_key]['embeddeds']) for func_key in functions2.keys() - common_functions_keys]
 
             fuzzy_matches = []
             max_fuzzy_similarity = (None, None, 0)
@@ -114,33 +152,73 @@ def compare_binary_files_and_functions(data1, data2):
             weighted_avg_similarity = 0.0
 
             if embeddings1_unmatched and embeddings2_unmatched:
-                prof_unmatched = PairWiseSimilarity(embeddings1_unmatched, embeddings2_unmatched, None)
+                if use_stores:
+                    unmatched_keys1 = get_ids_from_functions(embeddings1_unmatched)
+                    unmatched_keys2 = get_ids_from_functions(embeddings2_unmatched)
+                    prof_unmatched = PairWiseSimilarity.from_stores(
+                        store1, store1.rows(entry1['id'], unmatched_keys1), unmatched_keys1,
+                        store2, store2.rows(entry2['id'], unmatched_keys2), unmatched_keys2, None
+                    )
+                else:
+                    prof_unmatched = PairWiseSimilarity(embeddings1_unmatched, embeddings2_unmatched, None)
                 threshold = 0.5  # Similarity threshold to be set as needed
                 
-                fuzzy_matches, weighted_avg_similarity = BinaryHandler.compute_fuzzy_similarity(prof_unmatched, embeddings1_unmatched, embeddings2_unmatched, threshold)
-
-                similarity_matrix_unmatched = np.zeros((len(embeddings1_unmatched), len(embeddings2_unmatched)))
-                for i in range(len(embeddings1_unmatched)):
-                    for j in range(len(embeddings2_unmatched)):
-                        similarity_matrix_unmatched[i, j] = prof_unmatched._compute_similarity(
-                            np.expand_dims(embeddings1_unmatched[i][1], axis=0), 
-                            np.expand_dims(embeddings2_unmatched[j][1], axis=0)
-                        )
-                
-                best_match_unmatched, max_sim_unmatched = BinaryHandler.find_best_match_unmatched(similarity_matrix_unmatched, embeddings1_unmatched, embeddings2_unmatched)
-
-                # Verify that both variables have valid values
-                if best_match_unmatched is not None and max_sim_unmatched is not None:
-                    max_fuzzy_match = best_match_unmatched
-                    max_sim_unmatch = max_sim_unmatched
+                fuzzy_matches, weighted_avg_similarity = BinaryHandler.compute_fuzzy_similarity(prof_unmatched, embeddings1_unmatched, embeddings2_unmatched, threshold, matching)
+
+                similarity_matrix_unmatched = prof_unmatched.similarities
+
+                # One argpartition pass gives the top-k candidates of every unmatched function and the global best match
+                row_indices, row_scores = PairWiseSimilarity.top_k_rows(
+                    np.broadcast_to(np.arange(similarity_matrix_unmatched.shape[1]), similarity_matrix_unmatched.shape),
+                    similarity_matrix_unmatched, top_k
+                )
+                top_k_candidates_unmatched = BinaryHandler.top_k_candidates(
+                    row_indices, row_scores, prof_unmatched.list_ids_1, prof_unmatched.list_ids_2
+                )
+                best_match_unmatched = BinaryHandler.best_match_from_candidates(row_indices, row_scores)
+
+                if best_match_unmatched is not None:
+                    r, c, max_sim_unmatch = best_match_unmatched
+                    max_fuzzy_match = [(r, c)]
             
-            bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched = BinaryHandler.calculate_bfs_dfs_similarities(functions1, functions2)
+            if structure_similarity == 'cfg_kernel':
+                calculate_similarities = BinaryHandler.calculate_cfg_similarities
+                count_similarities_unmatched = BinaryHandler.count_cfg_similarities_unmatched
+            else:
+                calculate_similarities = BinaryHandler.calculate_bfs_dfs_similarities
+                count_similarities_unmatched = BinaryHandler.count_bfs_dfs_similarities_unmatched
+
+            graph_tasks, graph_timeouts = 0, 0
+            if graph_executor is not None:
+                # In cfg_kernel mode only the pairs without a stored CFG fall back to the BFS/DFS graphs
+                graph_tasks, graph_timeouts = BinaryHandler.precompute_graph_similarities(
+                    functions1, functions2, graph_executor, cfg_fallback_only=structure_similarity == 'cfg_kernel'
+                )
+                print(f"Graph similarity tasks for {entry1['filename']} vs {entry2['filename']}: {graph_tasks} submitted, {graph_timeouts} timed out")
+
+            if bfs_dfs_mode == 'vectorized':
+                bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched = calculate_similarities(functions1, functions2, include_unmatched=False)
+                bfs_dfs_unmatched_counts = count_similarities_unmatched(functions1, functions2)
+            else:
+                bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched = calculate_similarities(functions1, functions2)
+                bfs_dfs_unmatched_counts = None
+
+            # Kernel and BFS/DFS scores (pairs without a stored CFG) have their own thresholds, the
+            # pairs above threshold are counted here where the scorer of every pair is known
+            structure_counts = None
+            if structure_similarity == 'cfg_kernel':
+                structure_counts = (
+                    BinaryHandler.count_cfg_similarities_common(functions1, functions2, bfs_dfs_similarities_common),
+                    bfs_dfs_unmatched_counts if bfs_dfs_unmatched_counts is not None else count_similarities_unmatched(functions1, functions2),
+                )
 
             all_comparisons.append({
                 'file1': entry1['filename'],
                 'file2': entry2['filename'],
                 'common_functions': common_functions,
                 'embedding_comparisons': embedding_comparisons,
+                'top_k_candidates_common': top_k_candidates_common,
+                'top_k_candidates_unmatched': top_k_candidates_unmatched,
                 'max_similarity_common': max_similarity_common,
                 'fuzzy_matches': fuzzy_matches,
                 'weighted_avg_similarity': weighted_avg_similarity,
@@ -155,10 +233,97 @@ def compare_binary_files_and_functions(data1, data2):
                 'max_sim_unmatch': max_sim_unmatch,
                 'bfs_dfs_similarities_common': bfs_dfs_similarities_common,
                 'bfs_dfs_similarities_unmatched': bfs_dfs_similarities_unmatched,
+                'bfs_dfs_unmatched_counts': bfs_dfs_unmatched_counts,
+                'graph_similarity_tasks': graph_tasks,
+                'graph_similarity_timeouts': graph_timeouts,
+                'structure_similarity': structure_similarity,
+                'structure_counts': structure_counts,
             })
 
     return all_comparisons
 
+def score_comparisons(comparison_result, hotspot_similarity_scores, weight_for_hotspot=0.20):
+    """
+    Computes the similarity score of every file pair compared by compare_binary_files_and_functions,
+    adds the hotspot score, normalizes the scores and sorts the pairs by decreasing score.
+
+    :param comparison_result: List returned by compare_binary_files_and_functions, updated in place
+    :param hotspot_similarity_scores: Hotspot score of every pair, from OutputPrinter.maps_similarity_scores_hotspot
+    :param weight_for_hotspot: Weight of the hotspot score
+    :return: comparison_result
+    """
+    # Calculate similarity scores without normalization
+    for comparison in comparison_result:
+        embedding_comparisons = comparison['embedding_comparisons']
+        bfs_dfs_similarities_common = comparison['bfs_dfs_similarities_common']
+        fuzzy_matches = comparison['fuzzy_matches']
+        bfs_dfs_similarities_unmatched = comparison['bfs_dfs_similarities_unmatched']
+        bfs_dfs_unmatched_counts = comparison.get('bfs_dfs_unmatched_counts')
+        common_functions = comparison['common_functions']
+        component_sizes1 = comparison['component_size_file1']
+        component_sizes2 = comparison['component_size_file2']
+
+        avg_fuzzy_match = EmbeddedHandler.extract_and_calculate_fuzzy_similarity_mean(fuzzy_matches)
+        avg_embedding_similarity = EmbeddedHandler.extract_and_calculate_embedding_similarity_mean(embedding_comparisons)
+        left_component_similarity = GraphHandler.combined_similarity(component_sizes1, component_sizes2)
+
+        print(f"Similarity between left component graph {component_sizes1} and {component_sizes2}: {left_component_similarity:.4f}")
+        print()
+        print("bfs dfs common similarities", bfs_dfs_similarities_common)
+        if bfs_dfs_unmatched_counts is not None:
+            print(f"uncommond: {bfs_dfs_unmatched_counts[0]} of {bfs_dfs_unmatched_counts[1]} pairs above threshold")
+        else:
+            print("uncommond", bfs_dfs_similarities_unmatched)
+
+        # In cfg_kernel mode the (above threshold, total) counts were taken per scorer, see compare_binary_files_and_functions
+        structure_counts = comparison.get('structure_counts')
+        if structure_counts is not None:
+            final_similarity_common, final_similarity_unmatched = BinaryHandler.calculate_final_similarities(
+                bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched,
+                common_counts=structure_counts[0], unmatched_counts=structure_counts[1]
+            )
+        else:
+            final_similarity_common, final_similarity_unmatched = BinaryHandler.calculate_final_similarities(
+                bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched, unmatched_counts=bfs_dfs_unmatched_counts
+            )
+
+        print(f"Final BFS DFS similarity (common functions): {final_similarity_common:.2f}")
+        print(f"Final BFS DFS similarity (uncommon functions): {final_similarity_unmatched:.2f}")
+
+        similarity_score = (
+            0.5 * avg_embedding_similarity +
+            0.1 * len(common_functions) +
+            0.05 * avg_fuzzy_match +
+            0.05 * left_component_similarity +
+            0.05 * final_similarity_common +
+            0.05 * final_similarity_unmatched
+        )
+
+        comparison['similarity_score'] = similarity_score
+
+    # Add the hotspot score of every pair
+    for comparison in comparison_result:
+        key = f"{comparison['file1']}_{comparison['file2']}"
+        hotspot_score = hotspot_similarity_scores.get(key, 0.0)
+        comparison['similarity_score'] += weight_for_hotspot * hotspot_score
+        print(f"Hotspot Score for {key}: {hotspot_score:.4f}")
+
+    # Min-max normalization keeps the order, a single sort serves both scores
+    comparison_result.sort(key=lambda x: x['similarity_score'], reverse=True)
+
+    # Normalize scores
+    scores = [comp['similarity_score'] for comp in comparison_result]
+    max_score = max(scores)
+    min_score = min(scores)
+
+    for comparison in comparison_result:
+        if max_score > min_score:
+            comparison['similarity_score_normalized'] = (comparison['similarity_score'] - min_score) / (max_score - min_score)
+        else:
+            comparison['similarity_score_normalized'] = 0.0
+
+    return comparison_result
+
 if __name__ == "__main__":
     # List of databases to compare with bzoc500.db.
     """
@@ -222,6 +387,29 @@ if __name__ == "__main__":
         'file_50.db',
     ]
     reference_db = 'bzoc500.db'
+    embedding_batch_size = 256  # Number of functions embedded per SAFE session.run
+    embedding_workers = os.cpu_count()  # Number of processes disassembling and tokenizing functions
+    embedding_storage = 'float32'  # Embedding store mode: 'float32', 'float16' or 'int8'
+    matching_mode = 'greedy'  # Unmatched functions matching: 'greedy', 'hungarian' or 'sparse' (top-k Hungarian)
+    candidates_top_k = 5  # Candidates kept per function in the comparison results
+    bfs_dfs_mode = 'vectorized'  # Unmatched BFS/DFS similarities: 'vectorized' (above-threshold count only) or 'list' (every pair)
+    structure_similarity = 'bfs_dfs'  # Function structure score: 'bfs_dfs' or 'cfg_kernel' (WL kernel of the stored CFGs, BFS/DFS without one)
+    graph_workers = os.cpu_count()  # Processes computing the graph similarities networkx is needed for (None runs them in this process)
+    graph_task_timeout = 10.0  # Seconds a graph similarity may take before it gets the fallback score 0
+    prefilter_top_n = None  # Reference files fully compared per query file, ranked by their file signature (None compares all)
+    prefilter_evaluate = False  # Also run the exhaustive comparison and report the precision@10 lost by the prefilter
+
+    # Embeddings computed by previous runs are reused as long as the model files do not change
+    embedding_cache = EmbeddingCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache.db'), EmbeddedHandler.model_files())
+
+    # BFS/DFS similarities of graph shapes already compared, by this run or a previous one
+    BinaryHandler.similarity_cache = GraphSimilarityCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'graph_similarity_cache.db'))
+
+    # Graph similarities that need networkx run in worker processes, killed after graph_task_timeout
+    graph_executor = GraphSimilarityExecutor(graph_workers, graph_task_timeout) if graph_workers is not None else None
+
+    # The reference database is loaded, embedded and analyzed once for all the query databases
+    reference = ReferenceCorpus(reference_db, batch_size=embedding_batch_size, cache=embedding_cache, workers=embedding_workers, storage=embedding_storage)
 
     comparison_results = {}
     metrics_results = {}
@@ -232,13 +420,17 @@ if __name__ == "__main__":
         
         # Retrieve and calculate data
         data1 = db_handler.fetch_all_data(db_path)
-        data2 = db_handler.fetch_all_data(reference_db)
+        data2 = reference.data
         
-        data1 = EmbeddedHandler.calculate_embeddeds(data1, db_path)
-        data2 = EmbeddedHandler.calculate_embeddeds(data2, reference_db)
+        EmbeddedHandler.load_embedding_store(data1, db_path, embedding_storage, batch_size=embedding_batch_size, cache=embedding_cache, workers=embedding_workers)
+        cfg_count = CFGKernel.attach_features(data1)
+        print(f"CFG kernel features of {cfg_count} functions of {db_path}")
+
+        # Only the reference files with the most similar signatures go through the full comparison
+        candidate_files = reference.signature_index.rank(data1, prefilter_top_n) if prefilter_top_n is not None else None
 
         # Database comparison
-        comparison_result = compare_binary_files_and_functions(data1, data2)
+        comparison_result = compare_binary_files_and_functions(data1, data2, reference.file_features, matching_mode, candidates_top_k, candidate_files, bfs_dfs_mode, graph_executor, structure_similarity)
         
         # Store results
         comparison_results_without_normalization = []
@@ -252,44 +444,9 @@ if __name__ == "__main__":
 
         OutputPrinter.print_top_similar_files(comparison_result)
 
-        # Calculate similarity scores without normalization
-        for comparison in comparison_result:
-            embedding_comparisons = comparison['embedding_comparisons']
-            bfs_dfs_similarities_common = comparison['bfs_dfs_similarities_common']
-            fuzzy_matches = comparison['fuzzy_matches']
-            bfs_dfs_similarities_unmatched = comparison['bfs_dfs_similarities_unmatched']
-            common_functions = comparison['common_functions']
-            component_sizes1 = comparison['component_size_file1']
-            component_sizes2 = comparison['component_size_file2']
-
-            avg_fuzzy_match = EmbeddedHandler.extract_and_calculate_fuzzy_similarity_mean(fuzzy_matches)
-            avg_embedding_similarity = EmbeddedHandler.extract_and_calculate_embedding_similarity_mean(embedding_comparisons)
-            left_component_similarity = GraphHandler.combined_similarity(component_sizes1, component_sizes2)
-
-            print(f"Similarity between left component graph {component_sizes1} and {component_sizes2}: {left_component_similarity:.4f}")
-            print()
-            print("bfs dfs common similarities", bfs_dfs_similarities_common)
-            print("uncommond", bfs_dfs_similarities_unmatched)
-
-            final_similarity_common, final_similarity_unmatched = BinaryHandler.calculate_final_similarities(bfs_dfs_similarities_common, bfs_dfs_similarities_unmatched)
-
-            print(f"Final BFS DFS similarity (common functions): {final_similarity_common:.2f}")
-            print(f"Final BFS DFS similarity (uncommon functions): {final_similarity_unmatched:.2f}")
-
-            similarity_score = (
-                0.5 * avg_embedding_similarity +
-                0.1 * len(common_functions) +
-                0.05 * avg_fuzzy_match +
-                0.05 * left_component_similarity +
-                0.05 * final_similarity_common +
-                0.05 * final_similarity_unmatched
-            )
-            
-            comparison['similarity_score'] = similarity_score
-
         # Calcola gli hotspot e confronta
         hotspot_data1 = HotspotHandler.find_hotspot(data1)
-        hotspot_data2 = HotspotHandler.find_hotspot(data2)
+        hotspot_data2 = reference.hotspots
         
         OutputPrinter.print_hotspots(hotspot_data1, "the first dataset")
         OutputPrinter.print_hotspots(hotspot_data2, "the second dataset")
@@ -302,15 +459,13 @@ if __name__ == "__main__":
 
         hotspot_similarity_scores = OutputPrinter.maps_similarity_scores_hotspot(hotspot_comparison_result)
 
-        weight_for_hotspot = 0.20
-        for comparison in comparison_result:
-            key = f"{comparison['file1']}_{comparison['file2']}"
-            hotspot_score = hotspot_similarity_scores.get(key, 0.0)
-            comparison['similarity_score'] += weight_for_hotspot * hotspot_score
-            print(f"Hotspot Score for {key}: {hotspot_score:.4f}")
+        score_comparisons(comparison_result, hotspot_similarity_scores)
+
+        if candidate_files is not None and prefilter_evaluate:
+            exhaustive_result = compare_binary_files_and_functions(data1, data2, reference.file_features, matching_mode, candidates_top_k, bfs_dfs_mode=bfs_dfs_mode, graph_executor=graph_executor, structure_similarity=structure_similarity)
+            score_comparisons(exhaustive_result, hotspot_similarity_scores)
+            FileSignatureIndex.report_precision_loss(exhaustive_result, comparison_result, prefilter_top_n)
 
-        comparison_result.sort(key=lambda x: x['similarity_score'], reverse=True)
-        
         # Store scores without normalization
         for comparison in comparison_result:
             comparison_results_without_normalization.append({
@@ -325,19 +480,6 @@ if __name__ == "__main__":
         for comparison in comparison_result:
             print(f"File1: {comparison['file1']}, File2: {comparison['file2']}, Similarity: {comparison['similarity_score']:.4f}")
 
-        # Normalize scores
-        scores = [comp['similarity_score'] for comp in comparison_result]
-        max_score = max(scores)
-        min_score = min(scores)
-
-        for comparison in comparison_result:
-            if max_score > min_score:
-                comparison['similarity_score_normalized'] = (comparison['similarity_score'] - min_score) / (max_score - min_score)
-            else:
-                comparison['similarity_score_normalized'] = 0.0
-
-        comparison_result.sort(key=lambda x: x['similarity_score_normalized'], reverse=True)
-        
         # Store scores with normalization
         for comparison in comparison_result:
             comparison_results_with_normalization.append({
@@ -417,4 +559,15 @@ if __name__ == "__main__":
             with open(metrics_filename, 'w') as json_file:
                 json.dump(metrics_results, json_file, indent=4)
 
-        print(f"The results for the comparison between {db_path} and {reference_db} have been saved in 'metricsresult.json'.")
\ No newline at end of file
+        print(f"The results for the comparison between {db_path} and {reference_db} have been saved in 'metricsresult.json'.")
+
+        # Graph similarities computed for this database survive an interrupted run
+        BinaryHandler.similarity_cache.flush()
+
+    embedding_cache.print_stats()
+    embedding_cache.close()
+    BinaryHandler.similarity_cache.print_stats()
+    BinaryHandler.similarity_cache.close()
+    if graph_executor is not None:
+        graph_executor.print_stats()
+        graph_executor.close()
\ No newline at end of file
@@ -17,15 +17,34 @@ class DatabaseHandler:
         self.db_path1 = os.path.join(os.path.dirname(os.path.abspath(__file__)), db_name1)
         self.db_path2 = os.path.join(os.path.dirname(os.path.abspath(__file__)), db_name2)
 
-    def fetch_all_data(self, db_path):
+    # Columns of function_info loaded by fetch_all_data, the heavy ones are loaded on demand
+    FUNCTION_COLUMNS = ('function_id', 'filename_id', 'function_name', 'entry_point', 'address',
+                        'assembly_code', 'bytecodes', 'bfs_result', 'dfs_result')
+    LAZY_FUNCTION_COLUMNS = ('address', 'assembly_code')
+    # Columns only present in databases built by newer versions of the disassembly pipeline
+    OPTIONAL_FUNCTION_COLUMNS = ('cfg_edges',)
+
+    def fetch_all_data(self, db_path, lazy_columns=LAZY_FUNCTION_COLUMNS):
+        """
+        Loads the files of the database and their functions.
+
+        Columns in lazy_columns are not read (the similarity code does not use them), they can
+        be added to the function entries later with load_function_columns.
+
+        :param db_path: Path of the database
+        :param lazy_columns: function_info columns to skip
+        :return: Dictionary with the 'info' list of file entries, each with its 'functions'
+        """
         data = {}
         conn = sqlite3.connect(db_path)
         c = conn.cursor()
 
-        c.execute('''SELECT * FROM info''')
+        c.execute('''SELECT id, filename, namef, libreria, versione_libreria, compilatore,
+                    versione_compilatore, architettura, filetype, call_graph FROM info''')
         info_rows = c.fetchall()
 
         data['info'] = []
+        info_by_id = {}
         for row in info_rows:
             entry = {
                 'id': row[0],
@@ -41,32 +60,111 @@ class DatabaseHandler:
                 'functions': []
             }
             data['info'].append(entry)
+            # The first entry wins, as with the linear scan
+            info_by_id.setdefault(entry['id'], entry)
 
-        c.execute('''SELECT * FROM function_info''')
-        function_rows = c.fetchall()
-
-        for function_row in function_rows:
-            function_entry = {
-                'function_id': function_row[0],
-                'filename_id': function_row[1],
-                'function_name': function_row[2],
-                'entry_point': function_row[3],
-                'address': function_row[4],
-                'assembly_code': function_row[5],
-                'bytecodes': function_row[6],
-                'bfs_result': self._parse_json(function_row[7]),
-                'dfs_result': self._parse_json(function_row[8]),
-                'embeddeds': []
-            }
+        columns = [column for column in DatabaseHandler.FUNCTION_COLUMNS if column not in lazy_columns]
+        c.execute('''PRAGMA table_info(function_info)''')
+        existing_columns = {row[1] for row in c.fetchall()}
+        optional_columns = [column for column in DatabaseHandler.OPTIONAL_FUNCTION_COLUMNS if column in existing_columns]
+        columns += optional_columns
+        c.execute(f'''SELECT {', '.join(columns)} FROM function_info ORDER BY function_id''')
 
-            for info_entry in data['info']:
-                if info_entry['id'] == function_row[1]:
-                    info_entry['functions'].append(function_entry)
-                    break
+        for function_row in c:
+            function_entry = dict(zip(columns, function_row))
+            function_entry['bfs_result'] = self._parse_json(function_entry['bfs_result'])
+            function_entry['dfs_result'] = self._parse_json(function_entry['dfs_result'])
+            # Block-level CFG in the edge-list form of GraphManager.edge_list, None when not stored
+            function_entry['cfg_edges'] = self._parse_json(function_entry.get('cfg_edges')) or None
+            function_entry['embeddeds'] = []
+
+            info_entry = info_by_id.get(function_entry['filename_id'])
+            if info_entry is not None:
+                info_entry['functions'].append(function_entry)
 
         conn.close()
         return data
 
+    def load_function_columns(self, db_path, data, columns=LAZY_FUNCTION_COLUMNS):
+        """
+        Adds function_info columns skipped by fetch_all_data to the function entries of data.
+
+        :param db_path: Path of the database data was loaded from
+        :param data: Data returned by fetch_all_data
+        :param columns: function_info columns to load
+        :return: data
+        """
+        for column in columns:
+            if column not in DatabaseHandler.FUNCTION_COLUMNS:
+                raise ValueError(f"Unknown function_info column {column}")
+
+        functions_by_id = {}
+        for entry in data['info']:
+            for function in entry['functions']:
+                functions_by_id[function['function_id']] = function
+
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+        c.execute(f'''SELECT function_id, {', '.join(columns)} FROM function_info''')
+        for function_row in c:
+            function = functions_by_id.get(function_row[0])
+            if function is not None:
+                function.update(zip(columns, function_row[1:]))
+
+        conn.close()
+        return data
+
+    def store_function_tokens(self, db_path, token_rows, vocab_hash):
+        """
+        Stores the SAFE token id sequence of functions in the function_tokens table.
+
+        :param db_path: Path of the database
+        :param token_rows: List of tuples (function_id, token id sequence)
+        :param vocab_hash: Fingerprint of the word2id vocabulary used to compute the ids
+        """
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS function_tokens
+                    (function_id INTEGER PRIMARY KEY, token_ids BLOB, length INTEGER,
+                    dtype TEXT, vocab_hash TEXT,
+                    FOREIGN KEY(function_id) REFERENCES function_info(function_id))''')
+
+        rows = []
+        for function_id, token_ids in token_rows:
+            token_ids = np.asarray(token_ids)
+            # int16 halves the size of the column whenever the vocabulary allows it
+            dtype = 'int16' if token_ids.size == 0 or token_ids.max() <= np.iinfo(np.int16).max else 'int32'
+            rows.append((function_id, token_ids.astype(dtype).tobytes(), int(token_ids.size), dtype, vocab_hash))
+
+        c.executemany('''INSERT OR REPLACE INTO function_tokens (function_id, token_ids, length, dtype, vocab_hash)
+                        VALUES (?, ?, ?, ?, ?)''', rows)
+        conn.commit()
+        conn.close()
+
+    def fetch_function_tokens(self, db_path, vocab_hash):
+        """
+        Retrieves the token id sequences stored by store_function_tokens.
+
+        :param db_path: Path of the database
+        :param vocab_hash: Fingerprint of the current vocabulary, rows computed with another one are ignored
+        :return: Dictionary function_id -> int32 numpy array
+        """
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+
+        c.execute('''SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'function_tokens' ''')
+        if c.fetchone() is None:
+            conn.close()
+            return {}
+
+        c.execute('''SELECT function_id, token_ids, length, dtype FROM function_tokens WHERE vocab_hash = ?''', (vocab_hash,))
+        function_tokens = {}
+        for function_id, token_ids, length, dtype in c.fetchall():
+            function_tokens[function_id] = np.frombuffer(token_ids, dtype=dtype, count=length).astype(np.int32)
+
+        conn.close()
+        return function_tokens
+
     def _parse_json(self, json_str):
         if not json_str or json_str.strip() == "":
             return {}
@@ -1,11 +1,16 @@
 import os
 import sqlite3
 import json
+import time
 import networkx as nx
 from capstone import *
 from capstone.arm64 import *
 from Analysis import DatabaseFunctionAnalyzer, InstructionsConverter, FunctionNormalizer, SAFEEmbedder
+from TokenizerWorker import worker_context, init_tokenizer, tokenize_chunk, tokenize_ids_chunk, pad_batch
 from PairWiseSimilarity import PairWiseSimilarity
+from EmbeddingCache import EmbeddingCache
+from EmbeddingStore import EmbeddingStore
+from DatabaseHandler import DatabaseHandler
 import pprint
 import numpy as np
 from sklearn.metrics.pairwise import cosine_similarity
@@ -13,49 +18,132 @@ from node2vec import Node2Vec
 from networkx.algorithms.similarity import graph_edit_distance
 
 class EmbeddedHandler:
-        
+    # TensorFlow thread settings of the shared SAFE model, 0 means TensorFlow default
+    intra_op_threads = 0
+    inter_op_threads = 0
+
     def generate_function_key(function):
         #return (function['function_name'], function['entry_point'])
         return function['function_name']
 
-    def calculate_embeddeds(data, db_path):
-        db_analyzer = DatabaseFunctionAnalyzer(db_path)
-        functions_info = db_analyzer.get_functions_info_from_db()
+    def model_files():
+        # Files that determine the embedding of a function: the frozen graph and the vocabulary
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        return [os.path.join(src_dir, 'safe_aarch64.pb'), os.path.join(src_dir, 'word2id.json')]
+
+    def load_embedder():
+        # The model is loaded once per process and shared by every call
+        return SAFEEmbedder.get_shared(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'safe_aarch64.pb'),
+            intra_op_threads=EmbeddedHandler.intra_op_threads,
+            inter_op_threads=EmbeddedHandler.inter_op_threads
+        )
 
-        md = Cs(CS_ARCH_ARM64, CS_MODE_ARM)
-        md.detail = True
+    def calculate_embeddeds(data, db_path, batch_size=256, cache=None, workers=None):
+        """
+        Calculates the SAFE embedding of every function in data.
 
+        Identical functions (same bytecodes at the same entry point) are tokenized once, and
+        identical token sequences are embedded once. Disassembly and tokenization run in a pool
+        of worker processes, each one producing a whole padded batch; the calling process
+        consumes the batches and runs the inference.
+
+        :param data: Data returned by DatabaseHandler.fetch_all_data
+        :param db_path: Path of the database the data comes from
+        :param batch_size: Number of functions embedded per session.run
+        :param cache: Optional EmbeddingCache consulted before disassembling a function
+        :param workers: Number of tokenizer processes, None uses every core and 1 tokenizes in this process
+        :return: data, with the 'embeddeds' field of every function filled
+        """
         json_i2id_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'word2id.json')
-        converter = InstructionsConverter(json_i2id_path)
 
-        normalizer = FunctionNormalizer(max_instruction=150)
-        embedder = SAFEEmbedder(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'safe_aarch64.pb'))
-        embedder.loadmodel()
-        embedder.get_tensor()
+        # Token id sequences stored by tokenize_database skip the disassembly
+        db_handler = DatabaseHandler(db_path, db_path)
+        stored_tokens = db_handler.fetch_function_tokens(db_path, EmbeddingCache.hash_files([json_i2id_path]))
 
-        embeddings_with_ids = {}
+        # Function key and function hash of every function, in data order
+        function_hashes = []
+        embeddings_by_hash = {}
+        embeddings_by_tokens = {}
+        queued_hashes = set()
+
+        # Functions that need the model: (function hash, bytecodes, entry point)
+        pending_functions = []
+        # Functions that need the model and have their token ids stored: (function hash, token ids)
+        pending_tokenized = []
+        cached_count = 0
 
         for entry in data['info']:
             for function_info in entry['functions']:
-                function_name = function_info['function_name']
                 bytecode_string = function_info['bytecodes']
-                entry_point = int(function_info['entry_point'].replace("0x", ""), 16)
-                address = entry_point
+                function_key = EmbeddedHandler.generate_function_key(function_info)
+                function_hash = EmbeddingCache.hash_function(bytecode_string, function_info['entry_point'])
+                function_hashes.append((function_key, function_hash))
 
-                bytecode = bytes.fromhex(bytecode_string)
-                instructions = list(md.disasm(bytecode, address))
+                # Copies of an already seen function reuse its embedding
+                if function_hash in queued_hashes:
+                    continue
+                queued_hashes.add(function_hash)
 
-                result = db_analyzer.analyze(instructions)
+                if cache is not None:
+                    cached_embedding = cache.get(function_hash)
+                    if cached_embedding is not None:
+                        embeddings_by_hash[function_hash] = cached_embedding
+                        cached_count += 1
+                        continue
 
-                flattened_instructions = [instr for instr in result]
-                converted_instructions = converter.convert_to_ids(flattened_instructions)
+                token_ids = stored_tokens.get(function_info['function_id'])
+                if token_ids is not None:
+                    pending_tokenized.append((function_hash, token_ids))
+                else:
+                    pending_functions.append((function_hash, bytecode_string, function_info['entry_point']))
 
-                normalized_instructions, lengths = normalizer.normalize_functions([converted_instructions])
+        chunks = [pending_functions[i:i + batch_size] for i in range(0, len(pending_functions), batch_size)]
+        tokenized_chunks = [pending_tokenized[i:i + batch_size] for i in range(0, len(pending_tokenized), batch_size)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(chunks)))
 
-                embedding = embedder.embedd(normalized_instructions, lengths)
+        start_time = time.perf_counter()
+        embedded_count = 0
 
-                function_key = EmbeddedHandler.generate_function_key(function_info)
-                embeddings_with_ids[function_key] = embedding[0].tolist()
+        # The model is loaded only when a function is missing from the cache
+        if chunks or tokenized_chunks:
+            embedder = EmbeddedHandler.load_embedder()
+            init_tokenizer(db_path, json_i2id_path, 150)
+
+            if workers > 1:
+                # Workers never touch TensorFlow, they only disassemble and tokenize
+                with worker_context().Pool(workers, initializer=init_tokenizer, initargs=(db_path, json_i2id_path, 150)) as pool:
+                    batches = pool.imap(tokenize_chunk, chunks)
+                    # Stored token ids are embedded while the workers tokenize the rest
+                    for chunk in tokenized_chunks:
+                        embedded_count += EmbeddedHandler.embedd_batch(embedder, pad_batch(*zip(*chunk)), embeddings_by_hash, embeddings_by_tokens, cache)
+                    for batch in batches:
+                        embedded_count += EmbeddedHandler.embedd_batch(embedder, batch, embeddings_by_hash, embeddings_by_tokens, cache)
+            else:
+                for chunk in tokenized_chunks:
+                    embedded_count += EmbeddedHandler.embedd_batch(embedder, pad_batch(*zip(*chunk)), embeddings_by_hash, embeddings_by_tokens, cache)
+                for chunk in chunks:
+                    embedded_count += EmbeddedHandler.embedd_batch(embedder, tokenize_chunk(chunk), embeddings_by_hash, embeddings_by_tokens, cache)
+
+        elapsed_time = time.perf_counter() - start_time
+        throughput = embedded_count / elapsed_time if elapsed_time > 0 else 0.0
+        print(f"Embedded {embedded_count} functions of {db_path} in {elapsed_time:.2f}s ({throughput:.1f} functions/sec, batch size {batch_size}, {workers} tokenizer workers, {len(pending_tokenized)} pre-tokenized)")
+        if cache is not None:
+            print(f"Reused {cached_count} cached embeddings for {db_path}")
+
+        # Identical bodies at different addresses (.o and .so copies, helpers shared across versions)
+        # only collapse at the token level: the ratio is distinct token sequences / functions tokenized
+        tokenized_count = len(pending_functions) + len(pending_tokenized)
+        token_ratio = embedded_count / tokenized_count if tokenized_count > 0 else 1.0
+        print(f"Deduplication for {db_path}: {len(function_hashes)} functions, {len(queued_hashes)} distinct (entry point, bytecodes) pairs, "
+              f"{cached_count} from the cache, {tokenized_count} tokenized into {embedded_count} distinct token sequences "
+              f"(token-level ratio {token_ratio:.2%}, {1 - token_ratio:.2%} of the inferences saved)")
+
+        embeddings_with_ids = {}
+        for function_key, function_hash in function_hashes:
+            embeddings_with_ids[function_key] = embeddings_by_hash[function_hash]
 
         for info_entry in data['info']:
             for function in info_entry['functions']:
@@ -65,6 +153,105 @@ class EmbeddedHandler:
 
         return data
 
+    def load_embedding_store(data, db_path, storage='float32', batch_size=256, cache=None, workers=None, export=True):
+        """
+        Attaches the EmbeddingStore of db_path to data, memory-mapping the exported matrix when
+        it is up to date and calculating (and exporting) the embeddings otherwise.
+
+        :param data: Data returned by DatabaseHandler.fetch_all_data for db_path
+        :param db_path: Path of the database the data comes from
+        :param storage: Storage mode, one of EmbeddingStore.MODES
+        :param batch_size: Number of functions embedded per session.run
+        :param cache: Optional EmbeddingCache, its model fingerprint is also used for the export
+        :param workers: Number of tokenizer processes, None uses every core
+        :param export: Whether a freshly calculated store is written next to the database
+        :return: EmbeddingStore
+        """
+        model_hash = cache.model_hash if cache is not None else EmbeddingCache.hash_files(EmbeddedHandler.model_files())
+
+        store = EmbeddingStore.load(db_path, storage, model_hash)
+        if store is not None:
+            print(f"Memory-mapped the embeddings of {len(store.keys)} functions of {db_path}")
+            data['embedding_store'] = store
+            return store
+
+        data = EmbeddedHandler.calculate_embeddeds(data, db_path, batch_size=batch_size, cache=cache, workers=workers)
+        store = EmbeddingStore.from_data(data, storage)
+        if export:
+            store.save(db_path, model_hash)
+        return store
+
+    def tokenize_database(db_path, batch_size=256, workers=None):
+        """
+        Stores the SAFE token id sequence of every function of db_path in the function_tokens
+        table, so that calculate_embeddeds can feed them to the model without disassembling.
+
+        :param db_path: Path of the database to upgrade
+        :param batch_size: Number of functions tokenized per worker task
+        :param workers: Number of tokenizer processes, None uses every core
+        """
+        json_i2id_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'word2id.json')
+        vocab_hash = EmbeddingCache.hash_files([json_i2id_path])
+
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+        c.execute('''SELECT function_id, bytecodes, entry_point FROM function_info''')
+        functions = c.fetchall()
+        conn.close()
+
+        chunks = [functions[i:i + batch_size] for i in range(0, len(functions), batch_size)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(chunks)))
+
+        token_rows = []
+        if workers > 1:
+            with worker_context().Pool(workers, initializer=init_tokenizer, initargs=(db_path, json_i2id_path, 150)) as pool:
+                for rows in pool.imap(tokenize_ids_chunk, chunks):
+                    token_rows.extend(rows)
+        else:
+            init_tokenizer(db_path, json_i2id_path, 150)
+            for chunk in chunks:
+                token_rows.extend(tokenize_ids_chunk(chunk))
+
+        db_handler = DatabaseHandler(db_path, db_path)
+        db_handler.store_function_tokens(db_path, token_rows, vocab_hash)
+        print(f"Stored the token ids of {len(token_rows)} functions in {db_path}")
+
+    def embedd_batch(embedder, batch, embeddings_by_hash, embeddings_by_tokens, cache=None):
+        """
+        Runs a single SAFE inference over the token sequences of a batch that were never embedded.
+
+        :param embedder: SAFEEmbedder with the model loaded
+        :param batch: Tuple (function hashes, padded token id matrix, lengths) built by tokenize_chunk
+        :param embeddings_by_hash: Dictionary updated in place with function hash -> embedding
+        :param embeddings_by_tokens: Dictionary of the embeddings already computed, indexed by token sequence
+        :param cache: Optional EmbeddingCache the new embeddings are stored in
+        :return: Number of token sequences run through the model
+        """
+        function_hashes, normalized_instructions, lengths = batch
+
+        # Rows of the batch to embed, indexed by token sequence
+        rows_by_tokens = {}
+        for row, length in enumerate(lengths):
+            token_key = normalized_instructions[row, :length].tobytes()
+            if token_key not in embeddings_by_tokens and token_key not in rows_by_tokens:
+                rows_by_tokens[token_key] = row
+
+        if rows_by_tokens:
+            rows = list(rows_by_tokens.values())
+            embeddings = embedder.embedd(normalized_instructions[rows], lengths[rows])
+            for token_key, embedding in zip(rows_by_tokens.keys(), embeddings):
+                embeddings_by_tokens[token_key] = embedding.tolist()
+
+        for row, (function_hash, length) in enumerate(zip(function_hashes, lengths)):
+            embeddings_by_hash[function_hash] = embeddings_by_tokens[normalized_instructions[row, :length].tobytes()]
+
+        if cache is not None:
+            cache.put_many(function_hashes, [embeddings_by_hash[function_hash] for function_hash in function_hashes])
+
+        return len(rows_by_tokens)
+
     def extract_and_calculate_fuzzy_similarity_mean(fuzzy_matches):
         similarities = []
         for item in fuzzy_matches:
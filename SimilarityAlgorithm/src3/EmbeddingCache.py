@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import hashlib
+import numpy as np
+
+class EmbeddingCache:
+    """
+    On-disk cache of SAFE function embeddings.
+
+    Entries are keyed by the hash of the function bytecodes and entry point, and by the
+    fingerprint of the model files (frozen graph and word2id vocabulary), so a different model
+    never reuses embeddings computed by another one.
+    """
+
+    KEY_VERSION = 2
+
+    def __init__(self, cache_path, model_files):
+        self.cache_path = cache_path
+        # The key format is part of the fingerprint, entries written with an older format are dropped
+        self.model_hash = f"{EmbeddingCache.KEY_VERSION}:{EmbeddingCache.hash_files(model_files)}"
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(self.cache_path)
+        c = self.conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS cache_info
+                    (key TEXT PRIMARY KEY, value TEXT)''')
+
+        # Invalidate every entry if the cache was filled with another model
+        c.execute('''SELECT value FROM cache_info WHERE key = 'model_hash' ''')
+        row = c.fetchone()
+        if row is None or row[0] != self.model_hash:
+            if row is not None:
+                print(f"Model changed, invalidating embedding cache {self.cache_path}")
+            c.execute('''DROP TABLE IF EXISTS embeddings''')
+            c.execute('''INSERT OR REPLACE INTO cache_info (key, value) VALUES ('model_hash', ?)''', (self.model_hash,))
+        c.execute('''CREATE TABLE IF NOT EXISTS embeddings
+                    (function_hash TEXT PRIMARY KEY, embedding BLOB)''')
+        self.conn.commit()
+
+    @staticmethod
+    def hash_files(paths):
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def hash_function(bytecode_string, entry_point):
+        """
+        Hash identifying the token sequence of a function.
+
+        Whitespace and case do not change the bytes decoded by bytes.fromhex. The entry point is
+        part of the key because branch targets are absolute addresses in the disassembly, so
+        the same bytes at another address can produce different tokens.
+        """
+        normalized = ''.join(bytecode_string.split()).lower()
+        address = int(entry_point.replace("0x", ""), 16)
+        return hashlib.sha256(f"{address:x}:{normalized}".encode('ascii')).hexdigest()
+
+    def get(self, function_hash):
+        c = self.conn.cursor()
+        c.execute('''SELECT embedding FROM embeddings WHERE function_hash = ?''', (function_hash,))
+        row = c.fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def put_many(self, function_hashes, embeddings):
+        rows = [(function_hash, np.asarray(embedding, dtype=np.float32).tobytes())
+                for function_hash, embedding in zip(function_hashes, embeddings)]
+        self.conn.executemany('''INSERT OR REPLACE INTO embeddings (function_hash, embedding) VALUES (?, ?)''', rows)
+        self.conn.commit()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def print_stats(self):
+        print(f"Embedding cache {self.cache_path}: {self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.2%}")
+
+    def close(self):
+        self.conn.close()
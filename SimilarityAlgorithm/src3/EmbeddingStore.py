@@ -0,0 +1,249 @@
+import os
+import json
+import sqlite3
+import hashlib
+import tempfile
+import numpy as np
+from PairWiseSimilarity import PairWiseSimilarity
+
+class EmbeddingStore:
+    """
+    Contiguous matrix with the SAFE embeddings of every function of a database.
+
+    Rows are indexed by (filename_id, function key). The matrix is kept in float32, in float16,
+    or quantized to int8 with one scale per row (embedding = row * scale).
+
+    A store can be exported next to its database as one .npy matrix with a sidecar index and
+    opened again with np.load(..., mmap_mode='r'), so the processes comparing against the same
+    database share its pages.
+    """
+
+    MODES = ('float32', 'float16', 'int8')
+
+    def __init__(self, keys, embeddings, mode='float32', function_ids=None):
+        if mode not in EmbeddingStore.MODES:
+            raise ValueError(f"Unknown embedding storage mode {mode}, expected one of {EmbeddingStore.MODES}")
+
+        self.mode = mode
+        self.keys = list(keys)
+        self.index = {key: row for row, key in enumerate(self.keys)}
+        self.function_ids = list(function_ids) if function_ids is not None else None
+
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if mode == 'int8':
+            # Symmetric quantization, the largest component of every row is mapped to 127
+            max_abs = np.abs(embeddings).max(axis=1) if embeddings.size > 0 else np.zeros(len(self.keys), dtype=np.float32)
+            self.scales = np.where(max_abs > 0, max_abs / 127.0, 1.0).astype(np.float32)
+            self.matrix = np.round(embeddings / self.scales[:, None]).astype(np.int8)
+        else:
+            self.scales = None
+            self.matrix = embeddings.astype(mode)
+
+    @classmethod
+    def from_data(cls, data, mode='float32'):
+        """
+        Moves the embeddings calculated by EmbeddedHandler.calculate_embeddeds into a store.
+
+        The 'embeddeds' list of every function is emptied, the vectors only live in the store.
+        For the quantized modes the memory saved and the score deviation from float32 are printed.
+
+        :param data: Data with the 'embeddeds' field of every function filled
+        :param mode: Storage mode, one of EmbeddingStore.MODES
+        :return: EmbeddingStore
+        """
+        keys = []
+        function_ids = []
+        embeddings = []
+        for entry in data['info']:
+            for function in entry['functions']:
+                if len(function['embeddeds']) == 0:
+                    continue
+                keys.append(EmbeddingStore.function_store_key(function))
+                function_ids.append(function['function_id'])
+                embeddings.append(function['embeddeds'])
+                function['embeddeds'] = []
+
+        store = cls(keys, np.asarray(embeddings, dtype=np.float32).reshape(len(keys), -1), 'float32', function_ids)
+        if mode != 'float32':
+            reference = store
+            store = cls(keys, reference.matrix, mode, function_ids)
+            store.report(reference)
+
+        data['embedding_store'] = store
+        return store
+
+    @staticmethod
+    def function_store_key(function):
+        return (function['filename_id'], function['function_name'])
+
+    @staticmethod
+    def matrix_paths(db_path):
+        # <database>.embeddings.npy, <database>.embeddings.scales.npy (int8 only) and <database>.embeddings.json
+        prefix = os.path.splitext(db_path)[0] + '.embeddings'
+        return prefix + '.npy', prefix + '.scales.npy', prefix + '.json'
+
+    @staticmethod
+    def database_fingerprint(db_path):
+        """
+        Hash of the function_info columns the embeddings and their index depend on.
+
+        The file size and mtime would also change when other tables are written (the
+        function_tokens table of TokenizeDatabase.py), which must not invalidate the exports.
+        """
+        digest = hashlib.sha256()
+        conn = sqlite3.connect(db_path)
+        c = conn.cursor()
+        c.execute('''SELECT function_id, filename_id, function_name, entry_point, bytecodes FROM function_info ORDER BY function_id''')
+        for row in c:
+            digest.update(json.dumps(row).encode())
+        conn.close()
+        return digest.hexdigest()
+
+    def save(self, db_path, model_hash):
+        """
+        Exports the store next to db_path: the matrix as .npy and the function index as json.
+
+        Every file is written under a unique temporary name in the same directory and renamed,
+        so processes opening the matrix, or exporting it, at the same time never see a partial file.
+
+        :param db_path: Path of the database the embeddings were calculated from
+        :param model_hash: Fingerprint of the model files, as EmbeddingCache.model_hash
+        """
+        matrix_path, scales_path, index_path = EmbeddingStore.matrix_paths(db_path)
+
+        EmbeddingStore._write_npy(matrix_path, np.ascontiguousarray(self.matrix))
+        if self.scales is not None:
+            EmbeddingStore._write_npy(scales_path, self.scales)
+
+        index = {
+            'mode': self.mode,
+            'model_hash': model_hash,
+            'database': EmbeddingStore.database_fingerprint(db_path),
+            'keys': self.keys,
+            'function_ids': self.function_ids,
+        }
+        EmbeddingStore.atomic_write(index_path, 'w', lambda f: json.dump(index, f))
+        print(f"Exported the embeddings of {len(self.keys)} functions to {matrix_path}")
+
+    @staticmethod
+    def _write_npy(path, array):
+        EmbeddingStore.atomic_write(path, 'wb', lambda f: np.save(f, array))
+
+    @staticmethod
+    def atomic_write(path, mode, write):
+        """
+        Calls write(f) on a temporary file unique to this call and renames it to path.
+
+        :param path: Destination path
+        :param mode: File mode, 'w' or 'wb'
+        :param write: Function writing the contents to the open file
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            f = os.fdopen(fd, mode)
+        except BaseException:
+            # The descriptor is only closed by the file object once fdopen returns it
+            os.close(fd)
+            os.unlink(tmp_path)
+            raise
+
+        try:
+            with f:
+                # mkstemp creates the file readable by its owner only, the exports are shared like open() files
+                os.chmod(tmp_path, 0o644)
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, db_path, mode, model_hash, mmap_mode='r'):
+        """
+        Opens the matrix exported by save for db_path.
+
+        :param db_path: Path of the database
+        :param mode: Storage mode the matrix must have
+        :param model_hash: Fingerprint of the current model files
+        :param mmap_mode: Passed to np.load, 'r' maps the file read-only instead of reading it
+        :return: EmbeddingStore, or None if there is no export or it is stale
+        """
+        matrix_path, scales_path, index_path = EmbeddingStore.matrix_paths(db_path)
+        if not os.path.exists(index_path) or not os.path.exists(matrix_path):
+            return None
+
+        with open(index_path) as f:
+            index = json.load(f)
+        # The export is only valid for the same database contents, model and storage mode
+        if (index['mode'] != mode or index['model_hash'] != model_hash
+                or index['database'] != EmbeddingStore.database_fingerprint(db_path)):
+            return None
+
+        store = cls.__new__(cls)
+        store.mode = mode
+        store.keys = [tuple(key) for key in index['keys']]
+        store.index = {key: row for row, key in enumerate(store.keys)}
+        store.function_ids = index['function_ids']
+        store.matrix = np.load(matrix_path, mmap_mode=mmap_mode)
+        store.scales = np.load(scales_path, mmap_mode=mmap_mode) if mode == 'int8' else None
+        return store
+
+    def rows(self, filename_id, function_keys):
+        return [self.index[(filename_id, function_key)] for function_key in function_keys]
+
+    def vectors(self, rows):
+        # float32 embeddings of the given rows
+        if self.mode == 'int8':
+            return self.matrix[rows].astype(np.float32) * self.scales[rows, None]
+        return self.matrix[rows].astype(np.float32)
+
+    def similarity(self, rows_1, other, rows_2):
+        """
+        Dot product similarity between rows_1 of this store and rows_2 of other.
+
+        When both stores are int8 the product is computed on the quantized values in int32 and
+        scaled afterwards, otherwise the rows are converted to float32.
+
+        :return: float32 matrix of shape (len(rows_1), len(rows_2))
+        """
+        if self.mode == 'int8' and other.mode == 'int8':
+            quantized = self.matrix[rows_1].astype(np.int32) @ other.matrix[rows_2].astype(np.int32).T
+            return quantized.astype(np.float32) * self.scales[rows_1, None] * other.scales[None, rows_2]
+        return self.vectors(rows_1) @ other.vectors(rows_2).T
+
+    def aggregate_similarity(self, rows_1, other, rows_2, tile_size=1024, argmax=True):
+        """
+        Statistics of the similarity between rows_1 of this store and rows_2 of other, computed
+        by PairWiseSimilarity.aggregate_statistics without building the whole matrix.
+        """
+        return PairWiseSimilarity.aggregate_statistics(self.vectors(rows_1), other.vectors(rows_2), tile_size, argmax)
+
+    def top_k(self, rows_1, other, rows_2, k, block_size=None, memory_limit=256 << 20, per_column=False):
+        """
+        Running top-k similarities between rows_1 of this store and rows_2 of other, computed
+        in blocks by PairWiseSimilarity.tiled_top_k. Indices are positions in rows_1 and rows_2.
+        """
+        return PairWiseSimilarity.tiled_top_k(self.vectors(rows_1), other.vectors(rows_2), k, block_size, memory_limit, per_column)
+
+    def nbytes(self):
+        return self.matrix.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def report(self, reference, sample_size=1000):
+        """
+        Prints the memory used by the store and the largest similarity deviation from reference.
+
+        :param reference: float32 EmbeddingStore with the same keys
+        :param sample_size: Number of rows whose all-pairs similarities are compared
+        """
+        rows = list(range(min(sample_size, len(self.keys))))
+        max_deviation = 0.0
+        if rows:
+            deviation = np.abs(self.similarity(rows, self, rows) - reference.similarity(rows, reference, rows))
+            max_deviation = float(deviation.max())
+
+        # A list of Python floats costs a pointer plus a 24 bytes float object per component
+        list_bytes = reference.matrix.size * (8 + 24)
+        print(f"Embedding store ({self.mode}): {len(self.keys)} functions, {self.nbytes() / 1024:.1f} KiB "
+              f"({1 - self.nbytes() / max(reference.nbytes(), 1):.2%} less than float32, "
+              f"{1 - self.nbytes() / max(list_bytes, 1):.2%} less than Python lists), "
+              f"max score deviation from float32 {max_deviation:.6f}")
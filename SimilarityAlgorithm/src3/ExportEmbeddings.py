@@ -0,0 +1,25 @@
+import os
+import sys
+from DatabaseHandler import DatabaseHandler
+from EmbeddedHandler import EmbeddedHandler
+from EmbeddingCache import EmbeddingCache
+
+# Exports the embeddings of the given databases as memory-mappable .npy matrices, so that
+# CallerSim opens them without loading the model.
+
+if __name__ == "__main__":
+    db_list = sys.argv[1:]
+    if not db_list:
+        print("Usage: python3 ExportEmbeddings.py <database> [<database> ...]")
+        sys.exit(1)
+
+    embedding_storage = 'float32'  # Must match the embedding_storage of CallerSim
+    embedding_cache = EmbeddingCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'embedding_cache.db'), EmbeddedHandler.model_files())
+
+    for db_path in db_list:
+        db_handler = DatabaseHandler(db_path, db_path)
+        data = db_handler.fetch_all_data(db_path)
+        EmbeddedHandler.load_embedding_store(data, db_path, embedding_storage, cache=embedding_cache)
+
+    embedding_cache.print_stats()
+    embedding_cache.close()
@@ -0,0 +1,102 @@
+import numpy as np
+from EmbeddedHandler import EmbeddedHandler
+from MetricsHandler import MetricsHandler
+
+class FileSignatureIndex:
+    """
+    Cheap file-level signatures used to rank the reference files before the full comparison.
+
+    The signature of a file is the mean of its normalized SAFE embeddings (renormalized) and
+    the histogram of the sizes of its functions, in log2 bins. Both parts are unit vectors
+    concatenated with the weights sqrt(embedding_weight) and sqrt(1 - embedding_weight), so the
+    dot product of two signatures is
+    embedding_weight * cos(embeddings) + (1 - embedding_weight) * cos(histograms).
+    """
+
+    SIZE_BINS = 16
+
+    def __init__(self, data, embedding_weight=0.8):
+        self.embedding_weight = embedding_weight
+        self.file_ids = [entry['id'] for entry in data['info']]
+        self.signatures = FileSignatureIndex.file_signatures(data, embedding_weight)
+
+    @staticmethod
+    def file_embeddings(entry, store=None):
+        # Embeddings of the functions of a file, from the EmbeddingStore when data has one
+        if store is not None:
+            keys = {EmbeddedHandler.generate_function_key(function) for function in entry['functions']}
+            rows = [store.index[(entry['id'], key)] for key in keys if (entry['id'], key) in store.index]
+            return store.vectors(rows)
+        embeddings = [function['embeddeds'] for function in entry['functions'] if len(function['embeddeds']) > 0]
+        return np.asarray(embeddings, dtype=np.float32).reshape(len(embeddings), -1)
+
+    @staticmethod
+    def size_histogram(entry):
+        # Number of instructions of every function (4 bytes each on ARM64), in log2 bins
+        sizes = np.array([len(function['bytecodes'].split()) if function['bytecodes'] else 0 for function in entry['functions']])
+        bins = np.minimum(np.floor(np.log2(sizes + 1)).astype(int), FileSignatureIndex.SIZE_BINS - 1)
+        return np.bincount(bins, minlength=FileSignatureIndex.SIZE_BINS).astype(np.float32)
+
+    @staticmethod
+    def file_signatures(data, embedding_weight=0.8):
+        """
+        :param data: Data with embeddings, in the functions or in data['embedding_store']
+        :return: float32 matrix with the signature of every file of data['info'], in order
+        """
+        store = data.get('embedding_store')
+        embedding_parts = []
+        histogram_parts = []
+        for entry in data['info']:
+            embeddings = FileSignatureIndex.file_embeddings(entry, store)
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            pooled = (embeddings / np.where(norms > 0, norms, 1)).mean(axis=0) if len(embeddings) > 0 else None
+            embedding_parts.append(pooled)
+            histogram_parts.append(FileSignatureIndex.size_histogram(entry))
+
+        # Files without any embedding get a zero embedding part of the common dimension
+        dimension = next((len(part) for part in embedding_parts if part is not None), 0)
+        embedding_parts = [part if part is not None else np.zeros(dimension, dtype=np.float32) for part in embedding_parts]
+
+        signatures = []
+        for embedding_part, histogram_part in zip(embedding_parts, histogram_parts):
+            embedding_norm = np.linalg.norm(embedding_part)
+            histogram_norm = np.linalg.norm(histogram_part)
+            signatures.append(np.concatenate([
+                np.sqrt(embedding_weight) * (embedding_part / embedding_norm if embedding_norm > 0 else embedding_part),
+                np.sqrt(1 - embedding_weight) * (histogram_part / histogram_norm if histogram_norm > 0 else histogram_part),
+            ]))
+
+        return np.asarray(signatures, dtype=np.float32).reshape(len(signatures), dimension + FileSignatureIndex.SIZE_BINS)
+
+    def rank(self, data, top_n):
+        """
+        Ranks the indexed files for every file of data.
+
+        :param data: Query data, with embeddings
+        :param top_n: Number of candidate files kept per query file
+        :return: Dictionary id of the query file -> list of the ids of its top_n candidate files, best first
+        """
+        query_signatures = FileSignatureIndex.file_signatures(data, self.embedding_weight)
+        scores = query_signatures @ self.signatures.T
+
+        candidates = {}
+        top_n = min(top_n, len(self.file_ids))
+        for entry, row in zip(data['info'], scores):
+            best = np.argsort(-row, kind='stable')[:top_n]
+            candidates[entry['id']] = [self.file_ids[i] for i in best]
+        return candidates
+
+    def report_precision_loss(exhaustive_result, prefiltered_result, top_n, k=10):
+        """
+        Prints precision@k of a prefiltered run against the exhaustive one (library name and version relevance).
+
+        :param exhaustive_result: Sorted comparison result of every file pair
+        :param prefiltered_result: Sorted comparison result of the top_n candidates of every query file
+        """
+        exhaustive_precision = MetricsHandler.calculate_precision_recall_at_k(exhaustive_result, use_normalized_scores=True, max_k=k, consider_version=True)[0][-1]
+        prefiltered_precision = MetricsHandler.calculate_precision_recall_at_k(prefiltered_result, use_normalized_scores=True, max_k=k, consider_version=True)[0][-1]
+
+        print(f"Prefilter top-{top_n}: {len(prefiltered_result)} of {len(exhaustive_result)} file pairs compared, "
+              f"precision@{k} {prefiltered_precision:.2f}% vs {exhaustive_precision:.2f}% exhaustive "
+              f"(loss {exhaustive_precision - prefiltered_precision:.2f} points)")
+        return exhaustive_precision - prefiltered_precision
@@ -0,0 +1,50 @@
+import sys
+import time
+import itertools
+from BinaryHandler import BinaryHandler
+from DatabaseHandler import DatabaseHandler
+from EmbeddedHandler import EmbeddedHandler
+
+# Checks that the closed-form path graph similarity matches networkx's graph edit distance on
+# small graphs, then times both on the unmatched all-pairs workload of two files of a database.
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'bzoc500.db'
+    max_pairs = int(sys.argv[2]) if len(sys.argv) > 2 else 200  # Pairs timed with networkx
+
+    # Parity on every pair of paths with up to 7 nodes (exact search, no timeout hit)
+    mismatches = 0
+    paths = [[hex(0x1000 + 4 * i) for i in range(n)] for n in range(8)]
+    for path1, path2 in itertools.product(paths, repeat=2):
+        expected = BinaryHandler.compute_bfs_dfs_similarity_as_graph_nx(path1, path1, path2, path2)
+        result = BinaryHandler.compute_bfs_dfs_similarity_as_graph(path1, path1, path2, path2)
+        if abs(expected - result) > 1e-9:
+            mismatches += 1
+            print(f"Mismatch on paths of {len(path1)} and {len(path2)} nodes: {expected} != {result}")
+    print(f"Parity on {len(paths) ** 2} small path pairs: {mismatches} mismatches")
+
+    db_handler = DatabaseHandler(db_path, db_path)
+    data = db_handler.fetch_all_data(db_path)
+    if len(data['info']) < 2:
+        print("The database needs at least two files for the all-pairs benchmark")
+        sys.exit(0)
+
+    functions1 = {EmbeddedHandler.generate_function_key(f): f for f in data['info'][0]['functions']}
+    functions2 = {EmbeddedHandler.generate_function_key(f): f for f in data['info'][1]['functions']}
+    pairs = [(functions1[k1], functions2[k2]) for k1 in functions1.keys() - functions2.keys() for k2 in functions2.keys() - functions1.keys()]
+    print(f"Unmatched pairs between {data['info'][0]['filename']} and {data['info'][1]['filename']}: {len(pairs)}")
+
+    start_time = time.perf_counter()
+    scores = [BinaryHandler.compute_bfs_dfs_similarity_as_graph(f1['bfs_result'], f1['dfs_result'], f2['bfs_result'], f2['dfs_result']) for f1, f2 in pairs]
+    closed_form_time = time.perf_counter() - start_time
+
+    sample = pairs[:max_pairs]
+    start_time = time.perf_counter()
+    reference_scores = [BinaryHandler.compute_bfs_dfs_similarity_as_graph_nx(f1['bfs_result'], f1['dfs_result'], f2['bfs_result'], f2['dfs_result']) for f1, f2 in sample]
+    networkx_time = time.perf_counter() - start_time
+
+    differences = sum(1 for score, reference in zip(scores, reference_scores) if abs(score - reference) > 1e-9)
+    print(f"Closed form: {closed_form_time:.3f}s for {len(pairs)} pairs")
+    print(f"networkx: {networkx_time:.3f}s for {len(sample)} pairs, {differences} different scores (networkx stops at its 5s timeout on large graphs)")
+    if closed_form_time > 0 and len(sample) > 0:
+        print(f"Speedup per pair: {(networkx_time / len(sample)) / (closed_form_time / max(len(pairs), 1)):.1f}x")
@@ -0,0 +1,101 @@
+import sqlite3
+import networkx as nx
+
+class GraphSimilarityCache:
+    """
+    Memo of BFS/DFS graph similarities keyed by the structural signatures of the two graphs.
+
+    The similarity only depends on the shape of the graphs, not on their address labels, so
+    every pair of shapes is computed once per process. With a cache_path the memo is loaded
+    from and saved to sqlite, and reused across runs as long as ALGORITHM_VERSION and the
+    networkx version (its Weisfeiler-Lehman hashes changed between releases) do not change.
+    """
+
+    ALGORITHM_VERSION = 1
+
+    def __init__(self, cache_path=None):
+        self.cache_path = cache_path
+        self.hits = 0
+        self.misses = 0
+        self.similarities = {}
+        self.new_keys = []
+        self.conn = None
+
+        if cache_path is None:
+            return
+
+        self.conn = sqlite3.connect(cache_path)
+        c = self.conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS cache_info
+                    (key TEXT PRIMARY KEY, value TEXT)''')
+
+        # Similarities computed by another version of the algorithm are dropped
+        version = f"{GraphSimilarityCache.ALGORITHM_VERSION}:{nx.__version__}"
+        c.execute('''SELECT value FROM cache_info WHERE key = 'algorithm_version' ''')
+        row = c.fetchone()
+        if row is None or row[0] != version:
+            c.execute('''DROP TABLE IF EXISTS graph_similarities''')
+            c.execute('''INSERT OR REPLACE INTO cache_info (key, value) VALUES ('algorithm_version', ?)''', (version,))
+        c.execute('''CREATE TABLE IF NOT EXISTS graph_similarities
+                    (signature_1 TEXT, signature_2 TEXT, similarity REAL,
+                    PRIMARY KEY (signature_1, signature_2))''')
+        self.conn.commit()
+
+        c.execute('''SELECT signature_1, signature_2, similarity FROM graph_similarities''')
+        for signature_1, signature_2, similarity in c.fetchall():
+            self.similarities[(signature_1, signature_2)] = similarity
+
+    @staticmethod
+    def pair_key(signature_1, signature_2):
+        # The similarity is symmetric, both orders share one entry
+        return (signature_1, signature_2) if signature_1 <= signature_2 else (signature_2, signature_1)
+
+    def get_or_compute(self, signature_1, signature_2, compute):
+        """
+        :param compute: Function without arguments returning the similarity, called on a miss
+        :return: Similarity of the two shapes
+        """
+        key = GraphSimilarityCache.pair_key(signature_1, signature_2)
+        similarity = self.similarities.get(key)
+        if similarity is not None:
+            self.hits += 1
+            return similarity
+
+        self.misses += 1
+        similarity = compute()
+        self.similarities[key] = similarity
+        self.new_keys.append(key)
+        return similarity
+
+    def contains(self, signature_1, signature_2):
+        return GraphSimilarityCache.pair_key(signature_1, signature_2) in self.similarities
+
+    def put(self, signature_1, signature_2, similarity, persist=True):
+        # Similarities computed elsewhere (GraphSimilarityExecutor), fallback scores are not persisted
+        key = GraphSimilarityCache.pair_key(signature_1, signature_2)
+        self.similarities[key] = similarity
+        if persist:
+            self.new_keys.append(key)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def flush(self):
+        # Writes the similarities computed since the last flush
+        if self.conn is None or not self.new_keys:
+            return
+        rows = [(key[0], key[1], self.similarities[key]) for key in self.new_keys]
+        self.conn.executemany('''INSERT OR REPLACE INTO graph_similarities (signature_1, signature_2, similarity) VALUES (?, ?, ?)''', rows)
+        self.conn.commit()
+        self.new_keys = []
+
+    def print_stats(self):
+        print(f"Graph similarity cache {self.cache_path or '(memory)'}: {len(self.similarities)} shape pairs, "
+              f"{self.hits} hits, {self.misses} misses, hit rate {self.hit_rate():.2%}")
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,136 @@
+import os
+import time
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+
+def _graph_similarity_worker(conn):
+    # Worker loop: receives chunks of (index, results1, results2) and sends back (index, similarity) for every task
+    from BinaryHandler import BinaryHandler
+
+    # The imports above are not counted in the deadline of the first task
+    conn.send('ready')
+    while True:
+        chunk = conn.recv()
+        if chunk is None:
+            break
+        for index, results1, results2 in chunk:
+            similarity = BinaryHandler.graph_similarity(BinaryHandler.graph_from_results(results1), BinaryHandler.graph_from_results(results2))
+            conn.send((index, similarity))
+    conn.close()
+
+class GraphSimilarityExecutor:
+    """
+    Process pool running graph similarity jobs (BinaryHandler.graph_similarity on the graphs of two
+    BFS/DFS results) with a hard deadline per task.
+
+    Tasks are sent to the workers in chunks of chunk_size. The deadline of a task starts when the
+    worker finishes the previous one: a worker still busy with a task after task_timeout seconds is
+    killed and restarted, the task gets fallback_score and the rest of its chunk is sent again.
+    networkx's own timeout inside graph_edit_distance is only checked between iterations, this one
+    always holds.
+    """
+
+    def __init__(self, workers=None, task_timeout=10.0, chunk_size=16, fallback_score=0.0):
+        self.workers = max(1, workers if workers is not None else (os.cpu_count() or 1))
+        self.task_timeout = task_timeout
+        self.chunk_size = chunk_size
+        self.fallback_score = fallback_score
+        # Forked workers would inherit the TensorFlow session of the main process, which is not fork-safe
+        self.context = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+        self.pool = []
+        self.completed = 0
+        self.timed_out = 0
+
+    def _start_worker(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_graph_similarity_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return {'process': process, 'conn': parent_conn, 'tasks': deque(), 'deadline': None, 'ready': False}
+
+    def _stop_worker(self, worker):
+        worker['process'].kill()
+        worker['process'].join()
+        worker['conn'].close()
+
+    def map(self, tasks):
+        """
+        :param tasks: List of (results1, results2) pairs of BFS/DFS results
+        :return: Tuple (similarity of every task in order, indices of the tasks that timed out)
+        """
+        scores = [None] * len(tasks)
+        pending = deque()
+        for start in range(0, len(tasks), self.chunk_size):
+            pending.append([(index, tasks[index][0], tasks[index][1]) for index in range(start, min(start + self.chunk_size, len(tasks)))])
+
+        while len(self.pool) < min(self.workers, len(pending)):
+            self.pool.append(self._start_worker())
+
+        timed_out = []
+        while pending or any(worker['tasks'] for worker in self.pool):
+            for worker in self.pool:
+                if worker['ready'] and not worker['tasks'] and pending:
+                    chunk = pending.popleft()
+                    worker['conn'].send(chunk)
+                    worker['tasks'].extend(chunk)
+                    worker['deadline'] = time.monotonic() + self.task_timeout
+
+            busy = [worker for worker in self.pool if worker['tasks']]
+            starting = [worker for worker in self.pool if not worker['ready']]
+            timeout = max(0.0, min(worker['deadline'] for worker in busy) - time.monotonic()) if busy else None
+            ready = wait([worker['conn'] for worker in busy + starting], timeout)
+
+            for worker in starting:
+                if worker['conn'] not in ready:
+                    continue
+                try:
+                    worker['ready'] = worker['conn'].recv() == 'ready'
+                except EOFError:
+                    raise RuntimeError("A graph similarity worker exited while starting")
+
+            for worker in busy:
+                if worker['conn'] not in ready:
+                    continue
+                try:
+                    index, similarity = worker['conn'].recv()
+                except EOFError:
+                    # The worker died, its current task is handled like a timeout below
+                    worker['deadline'] = 0.0
+                    continue
+                worker['tasks'].popleft()
+                scores[index] = similarity
+                worker['deadline'] = time.monotonic() + self.task_timeout
+
+            now = time.monotonic()
+            for position, worker in enumerate(self.pool):
+                if not worker['tasks'] or worker['deadline'] > now:
+                    continue
+                self._stop_worker(worker)
+                index = worker['tasks'].popleft()[0]
+                scores[index] = self.fallback_score
+                timed_out.append(index)
+                if worker['tasks']:
+                    pending.appendleft(list(worker['tasks']))
+                self.pool[position] = self._start_worker()
+
+        self.completed += len(tasks) - len(timed_out)
+        self.timed_out += len(timed_out)
+        return scores, timed_out
+
+    def print_stats(self):
+        print(f"Graph similarity executor ({self.workers} workers, {self.task_timeout}s per task): "
+              f"{self.completed} tasks completed, {self.timed_out} timed out")
+
+    def close(self):
+        for worker in self.pool:
+            try:
+                worker['conn'].send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            worker['process'].join(1)
+            if worker['process'].is_alive():
+                worker['process'].kill()
+                worker['process'].join()
+            worker['conn'].close()
+        self.pool = []
@@ -21,6 +21,7 @@ class OutputPrinter:
         OutputPrinter.print_max_similarity_common(file_info)
         OutputPrinter.print_fuzzy_matches(file_info)
         OutputPrinter.print_max_fuzzy_match(file_info)
+        OutputPrinter.print_top_k_candidates(file_info)
         OutputPrinter.print_component_sizes(file_info)
         OutputPrinter.print_bfs_dfs_similarities_common(file_info)
         OutputPrinter.print_bfs_dfs_similarities_unmatched(file_info)
@@ -61,6 +62,13 @@ class OutputPrinter:
         else:
             print("  No fuzzy match found for unmatched functions.")
 
+    @staticmethod
+    def print_top_k_candidates(file_info):
+        print("Top Candidates for Unmatched Functions:")
+        for func_name, candidates in file_info.get('top_k_candidates_unmatched', {}).items():
+            formatted = ', '.join(f"{candidate} ({similarity:.4f})" for candidate, similarity in candidates)
+            print(f"  Function {func_name}: {formatted}")
+
     @staticmethod
     def print_component_sizes(file_info):
         print(f"Number of matched functions: {len(file_info['common_functions'])}")
@@ -79,6 +87,10 @@ class OutputPrinter:
     @staticmethod
     def print_bfs_dfs_similarities_unmatched(file_info):
         print("BFS and DFS Similarities for Unmatched Functions:")
+        if file_info.get('bfs_dfs_unmatched_counts') is not None:
+            above_threshold, total = file_info['bfs_dfs_unmatched_counts']
+            print(f"  {above_threshold} of {total} pairs above threshold")
+            return
         for bfs_dfs_similarity in file_info['bfs_dfs_similarities_unmatched']:
             func_name, similarity = bfs_dfs_similarity  # Considering `func_name` as a single element
             print(f"  Function {func_name}: BFS and DFS Similarity: {similarity}")
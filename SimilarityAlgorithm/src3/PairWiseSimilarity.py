@@ -1,10 +1,13 @@
 import os
 import logging
 import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+# The similarities are computed with NumPy, these only keep quiet the TensorFlow used by Analysis
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['CUDA_VISIBLE_DEVICES'] = ''
 logging.getLogger('tensorflow').disabled = True
-import tensorflow as tf
 
 from binsim_utility import *
 
@@ -14,8 +17,36 @@ class PairWiseSimilarity:
         self.logger = logger
         # Remember that list embeddings is a list of tuple of the form (id, horizontal np.array)
         # Need ids in the same order to be able to match embeddings with id function
-        self.list_ids_1 = get_ids_from_functions(list_embeddings_1)
-        self.list_ids_2 = get_ids_from_functions(list_embeddings_2)
+        self._set_ids(get_ids_from_functions(list_embeddings_1), get_ids_from_functions(list_embeddings_2))
+
+        # prepare to build sim matrix
+        self.list_embeddings_1 = list(map(lambda x: x[1], list_embeddings_1))
+        self.list_embeddings_2 = list(map(lambda x: x[1], list_embeddings_2))
+
+        self.similarities = self._compute_similarity(self.list_embeddings_1, self.list_embeddings_2)
+    
+    @classmethod
+    def from_stores(cls, store_1, rows_1, list_ids_1, store_2, rows_2, list_ids_2, logger):
+        """
+        Builds the similarity matrix from two EmbeddingStore, on their (possibly quantized) data.
+
+        :param store_1: EmbeddingStore of the first database
+        :param rows_1: Rows of store_1 to compare, in the order of list_ids_1
+        :param list_ids_1: Ids of the functions of the first set
+        :param store_2: EmbeddingStore of the second database
+        :param rows_2: Rows of store_2 to compare, in the order of list_ids_2
+        :param list_ids_2: Ids of the functions of the second set
+        :param logger: Logger used by get_max_match
+        """
+        prof = cls.__new__(cls)
+        prof.logger = logger
+        prof._set_ids(list(list_ids_1), list(list_ids_2))
+        prof.similarities = store_1.similarity(rows_1, store_2, rows_2)
+        return prof
+
+    def _set_ids(self, list_ids_1, list_ids_2):
+        self.list_ids_1 = list_ids_1
+        self.list_ids_2 = list_ids_2
 
         self.index_by_id_1 = dict()
         self.index_by_id_2 = dict()
@@ -26,23 +57,155 @@ class PairWiseSimilarity:
         for i, id in enumerate(self.list_ids_2):
             self.index_by_id_2[id] = i
 
-        # prepare to build sim matrix
-        self.list_embeddings_1 = list(map(lambda x: x[1], list_embeddings_1))
-        self.list_embeddings_2 = list(map(lambda x: x[1], list_embeddings_2))
-
-        self.ts_graph = tf.Graph()
-        self.similarities = self._compute_similarity(self.list_embeddings_1, self.list_embeddings_2)
-    
     def _compute_similarity(self, list_embeddings_1, list_embeddings_2):
+        """
+        Dot product of every embedding of list_embeddings_1 with every one of list_embeddings_2.
+
+        The whole matrix is a single BLAS matmul, no TensorFlow graph or session is created.
+
+        :return: float32 matrix of shape (len(list_embeddings_1), len(list_embeddings_2))
+        """
+        matrix_1 = np.asarray(list_embeddings_1, dtype=np.float32)
+        matrix_2 = np.asarray(list_embeddings_2, dtype=np.float32)
+        matrix_1 = matrix_1.reshape(len(matrix_1), -1)
+        matrix_2 = matrix_2.reshape(len(matrix_2), -1)
+        return matrix_1 @ matrix_2.T
+
+    @staticmethod
+    def aggregate_statistics(matrix_1, matrix_2, tile_size=1024, argmax=True):
+        """
+        Mean, diagonal, max and argmax of matrix_1 @ matrix_2.T without allocating the n x m matrix.
+
+        The mean is the dot product of the column sums divided by n * m, the diagonal is a row-wise
+        dot product, and the max is found over tile_size x tile_size blocks, so the memory used is
+        O((n + m) * d + tile_size^2).
+
+        :param matrix_1: Embeddings of shape (n, d)
+        :param matrix_2: Embeddings of shape (m, d)
+        :param tile_size: Rows and columns of the blocks scanned for the max
+        :param argmax: Whether to scan for the max, when False 'max' and 'argmax' are None
+        :return: Dictionary with 'mean', 'diagonal' (None unless n == m), 'max' and 'argmax' (row, column),
+                 the argmax being the first maximum in row-major order as with np.where
+        """
+        matrix_1 = np.asarray(matrix_1, dtype=np.float32)
+        matrix_2 = np.asarray(matrix_2, dtype=np.float32)
+        matrix_1 = matrix_1.reshape(len(matrix_1), -1)
+        matrix_2 = matrix_2.reshape(len(matrix_2), -1)
+        n, m = len(matrix_1), len(matrix_2)
+        if n == 0 or m == 0:
+            return {'mean': 0.0, 'diagonal': None, 'max': None, 'argmax': None}
+
+        mean = float(matrix_1.sum(axis=0, dtype=np.float64) @ matrix_2.sum(axis=0, dtype=np.float64)) / (n * m)
+        diagonal = np.einsum('ij,ij->i', matrix_1, matrix_2) if n == m else None
+
+        max_similarity = None
+        best_position = None
+        for row in range(0, n if argmax else 0, tile_size):
+            for col in range(0, m, tile_size):
+                tile = matrix_1[row:row + tile_size] @ matrix_2[col:col + tile_size].T
+                r, c = np.unravel_index(np.argmax(tile), tile.shape)
+                candidate = (row + int(r), col + int(c))
+                # On ties keep the first position in row-major order of the whole matrix
+                if max_similarity is None or tile[r, c] > max_similarity or (tile[r, c] == max_similarity and candidate < best_position):
+                    max_similarity = tile[r, c]
+                    best_position = candidate
+
+        return {'mean': mean, 'diagonal': diagonal, 'max': max_similarity, 'argmax': best_position}
+
+    @staticmethod
+    def tiled_top_k(matrix_1, matrix_2, k, block_size=None, memory_limit=256 << 20, per_column=False):
+        """
+        Top-k most similar embeddings of matrix_2 for every row of matrix_1 (and optionally the
+        top-k rows of matrix_1 for every row of matrix_2), without the n x m similarity matrix.
+
+        matrix_2 is processed in blocks of block_size rows: every block gives an n x block_size
+        tile whose scores are merged with the running top-k of each row. When block_size is None
+        it is derived from memory_limit (bytes), counting the tile and the merge buffers.
+        The selection is the same as top_k_rows on the dense matrix; scores can only differ in the
+        last bit, when BLAS rounds a tile differently from the whole product.
+
+        :param matrix_1: Embeddings of shape (n, d)
+        :param matrix_2: Embeddings of shape (m, d)
+        :param k: Number of candidates kept per row (and per column)
+        :return: Dictionary with 'row_indices' and 'row_scores' of shape (n, min(k, m)), and when
+                 per_column is set 'col_indices' and 'col_scores' of shape (m, min(k, n))
+        """
+        matrix_1 = np.asarray(matrix_1, dtype=np.float32)
+        matrix_2 = np.asarray(matrix_2, dtype=np.float32)
+        matrix_1 = matrix_1.reshape(len(matrix_1), -1)
+        matrix_2 = matrix_2.reshape(len(matrix_2), -1)
+        n, m = len(matrix_1), len(matrix_2)
+        k_rows, k_cols = min(k, m), min(k, n)
+
+        if block_size is None:
+            # Tile, merge buffers and the temporaries of top_k_rows take about 32 bytes per cell
+            block_size = max(1, memory_limit // (32 * max(n, 1)) - k_rows)
+
+        row_indices = np.empty((n, 0), dtype=np.int64)
+        row_scores = np.empty((n, 0), dtype=np.float32)
+        col_indices = np.empty((m, k_cols), dtype=np.int64)
+        col_scores = np.empty((m, k_cols), dtype=np.float32)
+
+        for start in range(0, m, block_size):
+            tile = matrix_1 @ matrix_2[start:start + block_size].T
+            block_indices = np.broadcast_to(np.arange(start, start + tile.shape[1]), tile.shape)
+
+            row_indices, row_scores = PairWiseSimilarity.top_k_rows(
+                np.concatenate([row_indices, block_indices], axis=1),
+                np.concatenate([row_scores, tile], axis=1),
+                k_rows
+            )
+
+            if per_column:
+                # Every tile holds all the rows of its columns, their top-k is final
+                col_indices[start:start + tile.shape[1]], col_scores[start:start + tile.shape[1]] = PairWiseSimilarity.top_k_rows(
+                    np.broadcast_to(np.arange(n), tile.T.shape), tile.T, k_cols
+                )
+
+        result = {'row_indices': row_indices, 'row_scores': row_scores}
+        if per_column:
+            result['col_indices'] = col_indices
+            result['col_scores'] = col_scores
+        return result
+
+    @staticmethod
+    def top_k_rows(indices, scores, k):
+        """
+        Keeps the k best entries of every row: decreasing score, ties broken by increasing index.
+
+        argpartition finds the k-th score of each row, then only the entries reaching it are sorted,
+        so ties on the k-th score are resolved the same way whatever the order of the columns.
+
+        :param indices: Column index of every score, shape (n, c)
+        :param scores: Scores of shape (n, c)
+        :return: (indices, scores) of shape (n, min(k, c))
+        """
+        n = scores.shape[0]
+        k = min(k, scores.shape[1])
+        if k == 0 or n == 0:
+            return np.empty((n, k), dtype=np.int64), np.empty((n, k), dtype=np.float32)
+
+        if scores.shape[1] > k:
+            kth = np.take_along_axis(scores, np.argpartition(-scores, k - 1, axis=1)[:, k - 1:k], axis=1)
+            rows, cols = np.nonzero(scores >= kth)
+        else:
+            rows, cols = np.nonzero(np.ones(scores.shape, dtype=bool))
+
+        candidate_scores = scores[rows, cols]
+        candidate_indices = indices[rows, cols]
+        order = np.lexsort((candidate_indices, -candidate_scores, rows))
+        rows, candidate_scores, candidate_indices = rows[order], candidate_scores[order], candidate_indices[order]
+
+        # Position of every candidate in its row, only the first k are kept
+        positions = np.arange(len(rows)) - np.searchsorted(rows, np.arange(n))[rows]
+        keep = positions < k
+
+        top_indices = np.empty((n, k), dtype=np.int64)
+        top_scores = np.empty((n, k), dtype=np.float32)
+        top_indices[rows[keep], positions[keep]] = candidate_indices[keep]
+        top_scores[rows[keep], positions[keep]] = candidate_scores[keep]
+        return top_indices, top_scores
 
-        with self.ts_graph.as_default():
-            tf.compat.v1.set_random_seed(1234)
-            self.matrix_1     = tf.constant(np.asarray(list_embeddings_1), name='matrix_embeddings_1', dtype=tf.float32)
-            self.matrix_2     = tf.constant(np.asarray(list_embeddings_2), name='matrix_embeddings_2', dtype=tf.float32)
-            self.similarities = tf.matmul(self.matrix_1, self.matrix_2, transpose_b=True, name="embeddings_similarities")
-            self.session = tf.compat.v1.Session()
-            return self.session.run(self.similarities)
-    
     # Take cue to create a similar function, matrices and submatrices to look for better match
     def get_max_match(self, list_functions_1, list_functions_2):
         try:
@@ -80,24 +243,95 @@ class PairWiseSimilarity:
 
     # Modified from the original slightly
     def get_fuzzy_matches(self, threshold):
-        if isinstance(self.similarities, tf.Tensor):
-            self.similarities = self.similarities.numpy()  # Convert TensorFlow tensor to NumPy array
+        """
+        Greedy one-to-one matching: pairs are taken by decreasing similarity, skipping the ones
+        whose row or column was already matched, until a pair falls below threshold.
 
-        fuzzy_matches = []
+        Only the k pairs above threshold are sorted, so it runs in O(k log k) instead of
+        rescanning and copying the matrix after every match. Ties are taken in row-major order.
+
+        :param threshold: Minimum similarity of a match
+        :return: List of tuples (id from list_ids_1, id from list_ids_2, similarity)
+        """
+        similarities = np.asarray(self.similarities)
+        rows, cols = np.nonzero(similarities >= threshold)
+        scores = similarities[rows, cols]
+        order = np.lexsort((cols, rows, -scores))
+
+        matched_rows = np.zeros(similarities.shape[0], dtype=bool)
+        matched_cols = np.zeros(similarities.shape[1], dtype=bool)
         n = min(len(self.list_ids_1), len(self.list_ids_2))
-        matrix = np.copy(self.similarities)
 
-        while n > 0:
-            max_score = np.amax(matrix)
-            if max_score < threshold:
-                return fuzzy_matches
+        fuzzy_matches = []
+        for k in order:
+            if len(fuzzy_matches) == n:
+                break
+            r, c = rows[k], cols[k]
+            if matched_rows[r] or matched_cols[c]:
+                continue
+            matched_rows[r] = True
+            matched_cols[c] = True
+            # r and c index the original matrix, so they map directly to the ids
+            fuzzy_matches.append((self.list_ids_1[r], self.list_ids_2[c], scores[k]))
+
+        return fuzzy_matches
+
+    def get_assignment_matches(self, threshold):
+        """
+        Optimal one-to-one matching: the Hungarian algorithm maximizes the total similarity of
+        the thresholded matrix (similarities below threshold count as 0 and are never reported).
+
+        :param threshold: Minimum similarity of a match
+        :return: List of tuples (id from list_ids_1, id from list_ids_2, similarity), by decreasing similarity
+        """
+        similarities = np.asarray(self.similarities)
+        thresholded = np.where(similarities >= threshold, similarities, 0)
+        rows, cols = linear_sum_assignment(thresholded, maximize=True)
+
+        return self._matches_above_threshold(similarities, rows, cols, threshold)
+
+    def get_sparse_assignment_matches(self, threshold, top_k=10):
+        """
+        Optimal one-to-one matching restricted to the top_k most similar functions of every row.
+
+        Every row also gets a private dummy column (left unmatched), so a full matching always
+        exists and scipy's sparse min_weight_full_bipartite_matching can be used on the
+        n x (m + n) candidate graph with cost = C - similarity, C being larger than every similarity.
+
+        :param threshold: Minimum similarity of a match
+        :param top_k: Number of candidates kept per row
+        :return: List of tuples (id from list_ids_1, id from list_ids_2, similarity), by decreasing similarity
+        """
+        similarities = np.asarray(self.similarities)
+        n, m = similarities.shape
+        if n == 0 or m == 0:
+            return []
+
+        k = min(top_k, m)
+        candidate_cols = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        candidate_rows = np.repeat(np.arange(n), k)
+        candidate_cols = candidate_cols.ravel()
+        candidate_scores = similarities[candidate_rows, candidate_cols]
+
+        keep = candidate_scores >= threshold
+        candidate_rows, candidate_cols, candidate_scores = candidate_rows[keep], candidate_cols[keep], candidate_scores[keep]
+        if len(candidate_scores) == 0:
+            return []
+
+        # Every full matching has n edges, so adding C to every cost does not change the optimum
+        offset = float(candidate_scores.max()) + 1.0
+        costs = np.concatenate([offset - candidate_scores, np.full(n, offset)])
+        graph_rows = np.concatenate([candidate_rows, np.arange(n)])
+        graph_cols = np.concatenate([candidate_cols, m + np.arange(n)])
+        graph = csr_matrix((costs, (graph_rows, graph_cols)), shape=(n, m + n))
+
+        rows, cols = min_weight_full_bipartite_matching(graph)
+        real = cols < m
 
-            rows, cols = np.where(matrix == max_score)
-            r, c = rows[0], cols[0]
+        return self._matches_above_threshold(similarities, rows[real], cols[real], threshold)
 
-            n -= 1
-            fuzzy_matches.append((self.list_ids_1[r], self.list_ids_2[c], max_score))
-            matrix = np.delete(matrix, r, axis=0)
-            matrix = np.delete(matrix, c, axis=1)
+    def _matches_above_threshold(self, similarities, rows, cols, threshold):
+        scores = similarities[rows, cols]
+        order = np.argsort(-scores, kind='stable')
 
-        return fuzzy_matches
\ No newline at end of file
+        return [(self.list_ids_1[rows[i]], self.list_ids_2[cols[i]], scores[i]) for i in order if scores[i] >= threshold]
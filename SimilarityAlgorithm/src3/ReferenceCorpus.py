@@ -0,0 +1,53 @@
+from DatabaseHandler import DatabaseHandler
+from EmbeddedHandler import EmbeddedHandler
+from GraphHandler import GraphHandler
+from HotspotHandler import HotspotHandler
+from FileSignature import FileSignatureIndex
+from CFGKernel import CFGKernel
+
+class ReferenceCorpus:
+    """
+    Reference database loaded and embedded once, then shared by every query database.
+
+    Besides the data returned by DatabaseHandler.fetch_all_data (with embeddings), it keeps
+    the per-file structures that compare_binary_files_and_functions would otherwise rebuild
+    for every query file, the hotspots of the whole database and the index of its file signatures.
+    """
+
+    def __init__(self, db_path, batch_size=256, cache=None, workers=None, storage=None):
+        self.db_path = db_path
+
+        db_handler = DatabaseHandler(db_path, db_path)
+        self.data = db_handler.fetch_all_data(db_path)
+        if storage is not None:
+            # Embeddings are kept in one contiguous (possibly quantized) matrix, memory-mapped
+            # from the export of a previous run when there is one
+            EmbeddedHandler.load_embedding_store(self.data, db_path, storage, batch_size=batch_size, cache=cache, workers=workers)
+        else:
+            self.data = EmbeddedHandler.calculate_embeddeds(self.data, db_path, batch_size=batch_size, cache=cache, workers=workers)
+
+        # Weisfeiler-Lehman vectors of the stored CFGs, CFG similarities become sparse dot products
+        cfg_count = CFGKernel.attach_features(self.data)
+        print(f"CFG kernel features of {cfg_count} functions of {db_path}")
+
+        self.file_features = {}
+        for entry in self.data['info']:
+            self.file_features[entry['id']] = ReferenceCorpus.compute_file_features(entry)
+
+        self.hotspots = HotspotHandler.find_hotspot(self.data)
+
+        # File-level signatures ranking the reference files before the full comparison
+        self.signature_index = FileSignatureIndex(self.data)
+
+    @staticmethod
+    def compute_file_features(entry):
+        """
+        Builds the per-file structures used when comparing the file with another one.
+
+        :param entry: File entry of the data returned by DatabaseHandler.fetch_all_data
+        :return: Dictionary with the functions indexed by key and the connected component sizes
+        """
+        return {
+            'functions': {EmbeddedHandler.generate_function_key(func): func for func in entry['functions']},
+            'component_sizes': GraphHandler.compute_left_connected_components(entry['call_graph'], entry['functions']),
+        }
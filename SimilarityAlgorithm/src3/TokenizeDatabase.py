@@ -0,0 +1,14 @@
+import sys
+from EmbeddedHandler import EmbeddedHandler
+
+# Upgrades the given databases with the function_tokens table, so that the embeddings of
+# their functions can be calculated without disassembling them again.
+
+if __name__ == "__main__":
+    db_list = sys.argv[1:]
+    if not db_list:
+        print("Usage: python3 TokenizeDatabase.py <database> [<database> ...]")
+        sys.exit(1)
+
+    for db_path in db_list:
+        EmbeddedHandler.tokenize_database(db_path)
@@ -0,0 +1,52 @@
+import sys
+import time
+from capstone import *
+from capstone.arm64 import *
+from Analysis import DatabaseFunctionAnalyzer
+from DatabaseHandler import DatabaseHandler
+
+# Checks that DatabaseFunctionAnalyzer.analyze produces the same tokens as the reference
+# op_str parser (analyze_op_str) on every function of a database, and compares their speed.
+
+if __name__ == "__main__":
+    db_path = sys.argv[1] if len(sys.argv) > 1 else 'bzoc500.db'
+
+    db_handler = DatabaseHandler(db_path, db_path)
+    data = db_handler.fetch_all_data(db_path)
+
+    md = Cs(CS_ARCH_ARM64, CS_MODE_ARM)
+    md.detail = False
+
+    functions_instructions = []
+    for entry in data['info']:
+        for function_info in entry['functions']:
+            entry_point = int(function_info['entry_point'].replace("0x", ""), 16)
+            bytecode = bytes.fromhex(function_info['bytecodes'])
+            functions_instructions.append(list(md.disasm(bytecode, entry_point)))
+
+    instruction_count = sum(len(instructions) for instructions in functions_instructions)
+    print(f"Functions: {len(functions_instructions)}, instructions: {instruction_count}")
+
+    reference_analyzer = DatabaseFunctionAnalyzer(db_path)
+    start_time = time.perf_counter()
+    reference_tokens = [reference_analyzer.analyze_op_str(instructions) for instructions in functions_instructions]
+    reference_time = time.perf_counter() - start_time
+
+    analyzer = DatabaseFunctionAnalyzer(db_path)
+    start_time = time.perf_counter()
+    tokens = [analyzer.analyze(instructions) for instructions in functions_instructions]
+    analyze_time = time.perf_counter() - start_time
+
+    mismatches = 0
+    for instructions, reference, result in zip(functions_instructions, reference_tokens, tokens):
+        for instruction, reference_token, token in zip(instructions, reference, result):
+            if reference_token != token:
+                mismatches += 1
+                if mismatches <= 10:
+                    print(f"Mismatch on '{instruction.mnemonic} {instruction.op_str}': {reference_token} != {token}")
+
+    print(f"Token mismatches: {mismatches}")
+    print(f"Reference op_str parser: {reference_time:.3f}s")
+    print(f"Memoized tokenizer: {analyze_time:.3f}s ({len(analyzer.token_memo)} distinct instructions)")
+    if analyze_time > 0:
+        print(f"Speedup: {reference_time / analyze_time:.2f}x")
@@ -0,0 +1,71 @@
+# Worker side of the tokenizer pools of EmbeddedHandler. The workers unpickle these functions by
+# importing this module, which only needs capstone and the tokenizer classes of Analysis
+
+import multiprocessing
+from capstone import *
+from capstone.arm64 import *
+from Analysis import DatabaseFunctionAnalyzer, InstructionsConverter, FunctionNormalizer
+
+# Disassembler and tokenizer of the current process, created by init_tokenizer
+_tokenizer = None
+
+def worker_context():
+    # The pools are created after the TensorFlow session is loaded, which is not fork-safe:
+    # workers start from a fresh forkserver (or spawned) process instead of a fork of this one
+    start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    return multiprocessing.get_context(start_method)
+
+def init_tokenizer(db_path, json_i2id_path, max_instructions):
+    global _tokenizer
+
+    # The tokenizer only reads mnemonic and op_str, the operand detail would just slow down disasm
+    md = Cs(CS_ARCH_ARM64, CS_MODE_ARM)
+    md.detail = False
+
+    _tokenizer = {
+        'md': md,
+        'analyzer': DatabaseFunctionAnalyzer(db_path),
+        'converter': InstructionsConverter(json_i2id_path),
+        'normalizer': FunctionNormalizer(max_instruction=max_instructions),
+    }
+
+def tokenize_function(bytecode_string, entry_point):
+    # Token id sequence of a function, not padded
+    md = _tokenizer['md']
+    db_analyzer = _tokenizer['analyzer']
+    converter = _tokenizer['converter']
+
+    address = int(entry_point.replace("0x", ""), 16)
+
+    bytecode = bytes.fromhex(bytecode_string)
+    instructions = list(md.disasm(bytecode, address))
+
+    result = db_analyzer.analyze(instructions)
+
+    flattened_instructions = [instr for instr in result]
+    return converter.convert_to_ids(flattened_instructions)
+
+def tokenize_chunk(chunk):
+    """
+    Disassembles and tokenizes a chunk of functions into one padded batch.
+
+    :param chunk: List of tuples (function hash, bytecodes, entry point)
+    :return: Tuple (function hashes, padded int32 token id matrix, lengths)
+    """
+    function_hashes = []
+    converted_functions = []
+
+    for function_hash, bytecode_string, entry_point in chunk:
+        function_hashes.append(function_hash)
+        converted_functions.append(tokenize_function(bytecode_string, entry_point))
+
+    return pad_batch(function_hashes, converted_functions)
+
+def tokenize_ids_chunk(chunk):
+    # Chunk of (function id, bytecodes, entry point), used to fill the function_tokens table
+    return [(function_id, tokenize_function(bytecode_string, entry_point)) for function_id, bytecode_string, entry_point in chunk]
+
+def pad_batch(function_hashes, converted_functions):
+    normalizer = _tokenizer['normalizer']
+    normalized_instructions, lengths = normalizer.normalize_functions(converted_functions)
+    return function_hashes, normalized_instructions, lengths